@@ -1,102 +1,250 @@
+import concurrent.futures
+import cProfile
 import datetime
 import ftplib
+import gzip
+import hashlib
+import html
+import http.server
+import io
 import json
+import mimetypes
 import os
 import pathlib
+import pstats
+import queue
 import re
 import shutil
 import string
 import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
 
-from itertools import chain
-from functools import reduce
+from itertools import repeat
 
 import PIL.Image, PIL.ExifTags
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 #
 # SiteBuilder
 #
 class SiteBuilder:
+    # outputs those get precompressed sidecars
+    precompress_ext = ('.html', '.css', '.js', '.svg')
+    # ioctl of Linux to share extents of a file (btrfs, xfs)
+    FICLONE = 0x40049409
+
     def __init__(self, setting):
         self.setting = setting
         self.upload_entry = set()
         self.dbm = DBManager(
                 setting)
-        self.im = ImageManager(setting['img_max_length'])
+        self.im = ImageManager.from_setting(setting)
+        ImgNode.configure(setting)
         self.uploader = Uploader(setting)
+        self.workers = setting.get('workers', 1)
+        # misc files to out_root: 'copy', 'hardlink' or 'reflink'
+        self.copy_mode = setting.get('copy_mode', 'copy')
+        # decoded images in memory at once
+        self.image_inflight = setting.get(
+                                'image_inflight', min(self.workers, 4))
+        # full text search index of documents
+        Publisher.collect_terms = bool(setting.get('search_index'))
+        self.search = None
+        if setting.get('search_index'):
+            self.search = SearchIndex(setting, self.dbm)
+        self.indexed = []
+        # sitemap.xml and Atom feed from the DB
+        self.sitemap = None
+        if setting.get('sitemap') or setting.get('feed'):
+            if setting.get('site_url'):
+                self.sitemap = SiteMap(setting, self.dbm)
+            else:
+                print('site_url is not set, sitemap and feed are not written.',
+                      file=sys.stderr)
+        self.publishers = dict()
+        self.templates = TemplateCache()
+        self.generation = 0
+        self.pool = None
+        self.deps = DependencyTracker(ContextManager.name_file)
+        # measurements of the last build
+        self.report = BuildReport()
+        # outputs given to update_site in the current build
+        self.offered = None
+        # sidecars to write: [] or some of 'gz', 'br'
+        self.precompress = list(filter(lambda x:
+                                    x == 'gz' or (x == 'br' and brotli),
+                                    setting.get('precompress', [])))
+        if 'br' in setting.get('precompress', []) and brotli is None:
+            print('brotli is not installed, .br files are not written.',
+                  file=sys.stderr)
+        self.compressor = None
     
-    def build(self):
+    # stats: {path: (mtime, size)} of src_root already gathered
+    # (by SourceWatcher), src_root is globbed if not given.
+    def build(self, stats=None):
         src_root = self.setting['src_root']
-        cut_ = len(str(pathlib.Path(src_root)))
         ignore_ = tuple(self.setting['ignore_files'])
         files_to_upload = []
+        self.report = BuildReport()
+        RootNode.timings = dict()
+
+        # templates are checked once per build
+        self.generation += 1
+        self.templates.begin_build(self.generation)
         
-        # gether files
-        everything = list(map(lambda x:
-                                str(x)[cut_:],
-                                pathlib.Path(src_root).glob('**/*')))
-        files = list(filter(lambda x:
-                                not os.path.isdir(src_root + x)
-                                and not x.endswith(ignore_),
-                                everything))
-
-        # add data of new file
-        new_files = list(filter(lambda x:
-                                    self.dbm.is_new(x),
-                                    files))
-        self.register_to_db(new_files)
-        
-        # update data of modified file        
-        mod_files = list(filter(lambda x:
-                                    self.dbm.is_modified(x),
-                                    files))
-        self.update_db(mod_files)
+        # gether files with their stat
+        if stats is None:
+            stats = self.scan()
+        else:
+            stats = dict(filter(lambda x:
+                                    self.is_source(x[0], ignore_),
+                                    stats.items()))
+        self.report.lap('scan')
+
+        # sort files out against a snapshot of the DB
+        self.dbm.load_snapshot()
+        new_files, mod_files, touched = self.dbm.classify(stats)
+        removed = list(filter(lambda x:
+                                x not in stats,
+                                self.dbm.snapshot))
+        dirs_before = self.deps.dirs_of(self.dbm.snapshot)
+
+        # add data of new file, update data of modified file
+        self.register_to_db(new_files, stats)
+        self.update_db(mod_files, stats)
+        self.dbm.touch_items(list(map(lambda x:
+                                    (x, ) + stats[x],
+                                    touched)))
+        self.dbm.remove_items(removed)
         
         # files to be done some process
-        jobs = new_files + mod_files 
+        jobs = list(filter(lambda x:
+                            not x.endswith(ignore_),
+                            new_files + mod_files))
+        # images made with other settings of ImageManager
+        jobs += self.stale_images(stats, jobs)
+
+        # documents and indexes affected by changes, each only once
+        dirs_after = self.deps.record(stats)
+        changed = (new_files + mod_files + removed +
+                    self.deps.changed_listings(
+                        new_files + removed, dirs_before, dirs_after))
+        docs, index_dirs = self.deps.affected(changed)
+        if self.search:
+            docs += self.search.missing(
+                        filter(lambda x:
+                                    not x.endswith(ignore_),
+                                    stats),
+                        docs)
+        index_dirs = list(filter(lambda x:
+                                    os.path.isdir(src_root + x),
+                                    index_dirs))
+        self.report.count(
+            new=len(new_files), modified=len(mod_files),
+            touched=len(touched), removed=len(removed))
+        self.report.lap('db')
         
         # make symmetrial dir in output
-        self.make_symmetrical_dirs(jobs)    
+        self.make_symmetrical_dirs(
+            jobs + docs + list(map(lambda x:
+                                self.deps.listing_of(x) + 'index.html',
+                                index_dirs)))
         
-        # txt(srcdir) -> html(outdir)
-        files_to_compile = list(filter(lambda x:
+        # outputs are uploaded while the others are being made
+        self.begin_deploy()
+        try:
+            # txt(srcdir) -> html(outdir)
+            files_to_compile = docs
+            files_to_upload += self.txt2html(files_to_compile)
+            if self.search:
+                # index words of documents just compiled
+                written = self.search.update(
+                            self.indexed,
+                            list(filter(lambda x:
                                             x.endswith('.txt'),
-                                            jobs))
-        files_to_upload += self.txt2html(files_to_compile)
+                                            removed)))
+                self.update_site(written, finish=False)
+                files_to_upload += written
+            # titles are kept for the sitemap and the feed
+            self.dbm.set_titles(list(map(lambda x:
+                                            (x[0], x[2]),
+                                            self.indexed)))
+            if self.sitemap:
+                # only when a document is added, modified or removed
+                written = self.sitemap.update(
+                            any(map(lambda x:
+                                        x.endswith('.txt'),
+                                        new_files + mod_files + removed)))
+                self.update_site(written, finish=False)
+                files_to_upload += written
+            self.report.lap('compile')
         
-        # resize and copy jpg files from secdir to outdir
-        jpg_files = list(filter(lambda x:
-                                    x.endswith(('jpg', '.jpeg')),
-                                    jobs))
-        files_to_upload += self.optimize_jpgs(jpg_files)
+            # resize and copy images from secdir to outdir
+            image_files = list(filter(self.im.handles, jobs))
+            files_to_upload += self.optimize_images(image_files)
+            self.report.lap('images')
         
-        # copy misc files from srcdir to outdir
-        files_to_copy = list(filter(lambda x:
-                                    not (x.endswith('.txt') or
-                                        x.endswith(('jpg', 'jpeg'))),
-                                    jobs))
-        files_to_upload += list(self.copy_to_out_dir(files_to_copy))
+            # copy misc files from srcdir to outdir
+            files_to_copy = list(filter(lambda x:
+                                        not (x.endswith('.txt') or
+                                            self.im.handles(x)),
+                                        jobs))
+            files_to_upload += list(self.copy_to_out_dir(files_to_copy))
+            self.report.lap('copy')
         
-        # list up dirs those need new index
-        modified_dirs = list(chain.from_iterable(
-                                    map(self.extract_path,jobs)))
-        files_to_upload += list(self.update_indexies(modified_dirs))
+            # dirs those need new index
+            files_to_upload += list(self.update_indexies(index_dirs))
+            self.report.lap('indexes')
         
-        files_to_upload = set(files_to_upload)
+            files_to_upload = set(files_to_upload)
+            self.report.count(
+                documents=len(docs), images=len(image_files),
+                copies=len(files_to_copy), indexes=len(index_dirs))
+            self.report.bytes['read'] = sum(map(lambda x:
+                                            stats.get(x, (0, 0))[1],
+                                            docs + image_files + files_to_copy))
+            self.report.bytes['written'] = sum(map(lambda x:
+                                            os.path.getsize(
+                                                self.setting['out_root'] + x),
+                                            files_to_upload))
+            self.report.add_nodes(RootNode.timings)
         
-        # upload them
-        self.update_site(files_to_upload)
+            # upload the rest of them
+            self.update_site(files_to_upload)
+            self.report.lap('upload')
+        except Exception:
+            # uploads of a failed build are not left running
+            # (an interrupted one is left to the daemon threads)
+            self.end_deploy()
+            raise
+        if self.setting.get('report_file'):
+            self.report.write(self.setting['report_file'])
     
-    def register_to_db(self, files):
-        for file in files:
-            mtime = self.get_mtime(file)
-            self.dbm.add_item(file, mtime, mtime)
+    def register_to_db(self, files, stats):
+        self.dbm.add_items(list(map(lambda x:
+                                    (x, stats[x][0], stats[x][0],
+                                        stats[x][1], stats[x][0],
+                                        self.dbm.digests.get(x)),
+                                    files)))
     
-    def update_db(self, files):
-        for file in files:
-            mtime = self.get_mtime(file)
-            self.dbm.update_item(file, mtime)
+    def update_db(self, files, stats):
+        self.dbm.update_items(list(map(lambda x:
+                                    (x, stats[x][0],
+                                        stats[x][1], stats[x][0],
+                                        self.dbm.digests.get(x)),
+                                    files)))
                 
     # make html from text files
     def txt2html(self, files):
@@ -109,32 +257,139 @@ class SiteBuilder:
                             self.__get_YYYYMMDD_from_timestamp(
                                     self.dbm.get_modified_time(x)),
                             files))
-        result = list(map(lambda x, y, z:
-                            self.__call_publisher(x, y, z, template),
+        terms = []
+        if self.workers > 1 and len(files) > 1:
+            # parallel compile mode
+            chunk_ = max(1, len(files) // (self.workers * 8))
+            done_ = self.get_pool().map(
+                            compile_worker,
                             files,
                             reg_time,
-                            mod_time))
+                            mod_time,
+                            repeat(template),
+                            repeat(self.generation),
+                            chunksize=chunk_)
+            # parse time of nodes is measured in workers
+            result = []
+            for x in done_:
+                result.append(x[0])
+                self.report.add_nodes(x[1])
+                self.update_site([x[0]], finish=False)
+                terms.append(x[2])
+        else:
+            result = []
+            for x, y, z in zip(files, reg_time, mod_time):
+                result.append(self.__call_publisher(x, y, z, template))
+                self.update_site(result[-1:], finish=False)
+                terms.append(self.publishers[template].terms)
+        # [(txt, url, title, terms), ...] for the search index
+        self.indexed = list(map(lambda x, y, z:
+                                (x, y) + z,
+                                files, result, terms))
         return result
     
-    # shrink too large jpg
-    def optimize_jpgs(self, files):
-        result = list(filter(lambda x: 
-                            self.im.do_resize(
-                                self.setting['src_root'] + x,
-                                self.setting['out_root'] + x),
-                            files))
+    # shrink too large jpg (and png, gif)
+    def optimize_images(self, files):
+        if self.workers > 1 and len(files) > 1:
+            done_ = self.imap_bounded(
+                        resize_worker, files, self.image_inflight)
+        else:
+            done_ = map(lambda x:
+                            call_resizer(self.im, self.setting, x),
+                            files)
+        result = []
+        failed = []
+        for file, error, outputs in done_:
+            if error:
+                print(f'failed to optimize {file}: {error}', file=sys.stderr)
+                failed.append(file)
+            else:
+                # with its smaller and WebP variants
+                result += outputs
+                self.update_site(outputs, finish=False)
+        # forget failed files, they will be tried again on next build
+        self.dbm.remove_items(failed)
+        self.dbm.set_derived(list(map(lambda x:
+                                    (x, self.im.signature(x)),
+                                    filter(lambda x: x not in failed, files))))
+        self.report.count(images_failed=len(failed))
         return result
 
+    def stale_images(self, stats, jobs):
+        derived = self.dbm.get_derived()
+        return list(filter(lambda x:
+                            self.im.handles(x)
+                            and x not in jobs
+                            and derived.get(x, self.im.signature(x))
+                                    != self.im.signature(x),
+                            stats))
+
     # copy misc files
     def copy_to_out_dir(self, files):
         from_ = files
         to_ = list(map(self.__check_name__, from_))
-        do_ = list(map(lambda x, y:
-                        shutil.copy2(
-                            self.setting['src_root'] + x,
-                            self.setting['out_root'] + y),
-                        from_, to_))
+        saved = 0
+        for x, y in zip(from_, to_):
+            saved += self.copy_file(
+                        self.setting['src_root'] + x,
+                        self.setting['out_root'] + y)
+            self.update_site([y], finish=False)
+        self.report.bytes['saved'] = saved
         return to_
+
+    # copy by copy_mode, falls back to copy.
+    # returns bytes not written (skipped, linked or cloned).
+    def copy_file(self, src, dst):
+        st_ = os.stat(src)
+        try:
+            out_ = os.stat(dst)
+            if (out_.st_size == st_.st_size
+                    and int(out_.st_mtime) == int(st_.st_mtime)):
+                # copied (or linked) already
+                return st_.st_size
+        except FileNotFoundError:
+            pass
+        # a link made in 'hardlink' mode is not written through
+        unlink_shared(dst)
+        if self.copy_mode == 'hardlink':
+            tmp_ = dst + '.link.tmp'
+            try:
+                os.link(src, tmp_)
+                os.replace(tmp_, dst)
+                return st_.st_size
+            except OSError:
+                # across file systems, or not supported
+                pass
+        elif self.copy_mode == 'reflink':
+            done_ = self.clone_file(src, dst)
+            if done_:
+                shutil.copystat(src, dst)
+                # only a clone shares space on the disk
+                return st_.st_size if done_ == 'clone' else 0
+        shutil.copy2(src, dst)
+        return 0
+
+    # 'clone' if dst shares the extents of src, 'range' if copied in
+    # the kernel, None if neither is supported
+    def clone_file(self, src, dst):
+        if fcntl is None:
+            return None
+        with open(src, mode='rb') as in_, open(dst, mode='wb') as out_:
+            try:
+                fcntl.ioctl(out_.fileno(), self.FICLONE, in_.fileno())
+                return 'clone'
+            except OSError:
+                pass
+            # the file system may share extents on this, too
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while os.copy_file_range(
+                            in_.fileno(), out_.fileno(), 1 << 30):
+                        pass
+                    return 'range'
+                except OSError:
+                    pass
+        return None
     
     def __check_name__(self, file):
         if os.path.basename(file)[0] == '_':
@@ -148,45 +403,341 @@ class SiteBuilder:
     # generate index file
     def update_indexies(self, files):
         template = self.setting['templates']['index']
-        result = list(map(lambda x:
-                            self.__call_publisher(x, '-', '-', template),
-                            files))
+        result = []
+        for x in files:
+            result.append(self.__call_publisher(x, '-', '-', template))
+            self.update_site(result[-1:], finish=False)
         return result
         
     def __call_publisher(   self,
                             file,
                             reg_time='-', mod_time='-',
                             template=''):
-        p = Publisher(template)
-        result = p.publish(
-            src_root = self.setting['src_root'],
-            out_root = self.setting['out_root'],
-            target_path = file,
-            registered_time = reg_time,
-            modified_time = mod_time,
-            title_prefix = self.setting['site_name'] + ' - ')
-        return result
+        return call_publisher(
+                    self.publishers, self.templates, self.setting,
+                    file, reg_time, mod_time, template)
+
+    # worker processes are forked at the first use, then kept
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                            max_workers=self.workers,
+                            initializer=init_worker,
+                            initargs=(self.setting, ))
+        return self.pool
+
+    # run func over items on the pool, with at most 'limit' items in
+    # flight. yields (item, error) in order of completion.
+    def imap_bounded(self, func, items, limit):
+        pool = self.get_pool()
+        pending = dict()
+        def collect(futures):
+            for f in futures:
+                item = pending.pop(f)
+                try:
+                    yield f.result()
+                except Exception as e:
+                    yield (item, f'{type(e).__name__}: {e}')
+        for item in items:
+            if len(pending) >= max(1, limit):
+                done, _ = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from collect(done)
+            pending[pool.submit(func, item)] = item
+        yield from collect(list(concurrent.futures.as_completed(pending)))
+
+    # build under cProfile, stats are dumped to path
+    def profile(self, path, stats=None):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            self.build(stats)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+        pstats.Stats(path).sort_stats('cumulative').print_stats(20)
+
+    # build again whenever src_root changes, until interrupted.
+    # DB, templates, worker pool and FTP connections are kept warm.
+    def watch(self):
+        interval = self.setting.get('watch_interval', 0.2)
+        # changes within this many seconds are built together
+        quiet = self.setting.get('watch_quiet', 0.3)
+        watcher = SourceWatcher(self.setting['src_root'])
+        watcher.poll()
+        self.build(watcher.stats)
+        print(f"watching {self.setting['src_root']} (Ctrl-C to stop)")
+        try:
+            while True:
+                time.sleep(interval)
+                if not watcher.poll():
+                    continue
+                settled = time.perf_counter()
+                while time.perf_counter() - settled < quiet:
+                    time.sleep(interval / 2)
+                    if watcher.poll():
+                        settled = time.perf_counter()
+                started = time.perf_counter()
+                try:
+                    self.build(watcher.stats)
+                except Exception as e:
+                    # keep watching, a fixed file is built next time
+                    print(f'failed to build: {type(e).__name__}: {e}',
+                            file=sys.stderr)
+                    self.end_deploy()
+                    continue
+                print(f'built in {time.perf_counter() - started:.2f} '
+                      f'seconds')
+        except KeyboardInterrupt:
+            pass
+
+    # preview pages on http://address:port/, rendered from src_root
+    # in memory. nothing is written to out_root or uploaded.
+    def serve(self):
+        address = self.setting.get('preview_address', '127.0.0.1')
+        port = self.setting.get('preview_port', 8000)
+        self.dbm.load_snapshot()
+        previewer = Previewer(self)
+        server = http.server.HTTPServer(
+                    (address, port),
+                    lambda *x: PreviewHandler(*x, previewer=previewer))
+        print(f'serving {self.setting["src_root"]} on '
+              f'http://{address}:{port}/ (Ctrl-C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.compressor is not None:
+            self.compressor.shutdown()
+            self.compressor = None
+        self.uploader.close()
     
     def __get_YYYYMMDD_from_timestamp(self, timestamp):
         dt_ = datetime.datetime.fromtimestamp(timestamp)
         return dt_.strftime('%Y/%m/%d')
         
-    def update_site(self, files):
+    def begin_deploy(self):
+        self.offered = set()
+        # offered but not uploaded (gone, or same as remote)
+        self.settled = []
+        self.digests = dict()
+        self.manifest = None
+        self.compressing = []
+        # left by an interrupted deploy, offered at the end
+        self.leftover = self.dbm.get_pending()
+        # not written to the pending table yet
+        self.unpended = []
+        self.pended = time.perf_counter()
+
+    # a failed build leaves uploads running. they are waited for and
+    # recorded with their digests before the next build starts.
+    def end_deploy(self):
+        if self.offered is None:
+            return
+        self.offered = None
+        concurrent.futures.wait(self.compressing)
+        # sidecars written but not offered go next time
+        for future in self.compressing:
+            if future.exception() is None:
+                self.pend(future.result())
+        self.compressing = []
+        self.pend([], flush=True)
+        if self.uploader.running():
+            self.uploader.finish()
+
+    # pending files are written in batches, as uploaded ones are
+    def pend(self, files, flush=False):
+        self.unpended += files
+        if self.unpended and (flush or len(self.unpended) >= 100
+                or time.perf_counter() - self.pended > 1.0):
+            self.dbm.add_pending(self.unpended)
+            self.unpended = []
+            self.pended = time.perf_counter()
+
+    # upload files those differ from the remote manifest.
+    # files given with finish=False go to the uploader right away,
+    # then finish waits for all of them.
+    def update_site(self, files, finish=True):
+        if self.offered is None:
+            self.begin_deploy()
+        out_root = self.setting['out_root']
+        files = sorted(set(map(lambda x:
+                                '/' + x.lstrip('/'),
+                                files)).difference(self.offered))
+        self.offered.update(files)
+        to_upload = []
         for file in files:
-            self.uploader.mirroring_file(file)
+            if not os.path.isfile(out_root + file):
+                self.settled.append(file)
+                continue
+            if self.manifest is None:
+                self.manifest = self.load_manifest()
+            digest = DBManager.digest(out_root + file)
+            if self.manifest.get(file) == digest:
+                self.settled.append(file)
+                if not self.has_sidecars(file):
+                    self.compress(file)
+                continue
+            self.digests[file] = digest
+            to_upload.append(file)
+            self.compress(file)
+        if to_upload:
+            self.pend(to_upload)
+            if not self.uploader.running():
+                self.uploader.start(self.record_uploaded)
+            for file in to_upload:
+                self.uploader.put(file)
+        # compressed sidecars go the same way
+        self.offer_sidecars(wait=finish)
+        if not finish:
+            return
+        if self.leftover:
+            # after outputs of this build, those may be made again.
+            # sidecars last, as their files may be written again too.
+            leftover, self.leftover = self.leftover, []
+            self.update_site(list(filter(lambda x:
+                                    not x.endswith(tuple(map(lambda y:
+                                                        '.' + y,
+                                                        self.precompress))),
+                                    leftover)), finish=False)
+            self.offer_sidecars(wait=True)
+            self.update_site(leftover, finish=False)
+            self.offer_sidecars(wait=True)
+        self.dbm.remove_pending(self.settled)
+        self.offered = None
+        if not self.uploader.running():
+            return
+        self.pend([], flush=True)
+        summary = self.uploader.finish()
+        self.save_manifest()
+        self.report.count(
+            uploads=summary['files'], upload_failed=len(summary['failed']),
+            reconnects=summary['reconnects'])
+        self.report.bytes['uploaded'] = summary['bytes']
+        self.report.latencies = summary['latencies']
+
+    # write sidecars of changed output in compressor threads
+    def compress(self, file):
+        if not (self.precompress and file.endswith(self.precompress_ext)):
+            return
+        if self.compressor is None:
+            self.compressor = concurrent.futures.ThreadPoolExecutor(
+                                max(1, self.workers))
+        self.compressing.append(
+            self.compressor.submit(
+                write_sidecars,
+                self.setting['out_root'], file, self.precompress))
+
+    def has_sidecars(self, file):
+        if not (self.precompress and file.endswith(self.precompress_ext)):
+            return True
+        return all(map(lambda x:
+                        os.path.isfile(
+                            self.setting['out_root'] + file + '.' + x),
+                        self.precompress))
+
+    def offer_sidecars(self, wait=False):
+        if wait:
+            concurrent.futures.wait(self.compressing)
+        done = list(filter(lambda x: x.done(), self.compressing))
+        self.compressing = list(filter(lambda x:
+                                    x not in done,
+                                    self.compressing))
+        for future in done:
+            self.update_site(future.result(), finish=False)
+
+    # called in this thread with files the uploader has done
+    def record_uploaded(self, done):
+        out_root = self.setting['out_root']
+        self.dbm.set_remote_items(list(map(lambda x:
+                                    (x, self.digests[x],
+                                        os.path.getsize(out_root + x)),
+                                    done)))
+        # done before they were written to the pending table
+        done_ = set(done)
+        self.unpended = list(filter(lambda x:
+                                        x not in done_,
+                                        self.unpended))
+        self.dbm.remove_pending(done)
+
+    # path -> digest of what the server holds
+    def load_manifest(self):
+        manifest = self.dbm.get_remote_manifest()
+        mirror = self.setting.get('remote_manifest')
+        if mirror:
+            data = self.uploader.get_bytes(mirror)
+            remote_ = json.loads(data) if data else dict()
+            if remote_ != manifest:
+                # deployed from somewhere else. trust the server.
+                print(f'remote manifest differs from local one, '
+                      f'{mirror} on the server is used.')
+                self.dbm.replace_remote_manifest(list(map(lambda x:
+                                                (x[0], x[1], None),
+                                                remote_.items())))
+                manifest = remote_
+        return manifest
+
+    def save_manifest(self):
+        mirror = self.setting.get('remote_manifest')
+        if mirror:
+            data = json.dumps(self.dbm.get_remote_manifest(),
+                                indent=0, sort_keys=True)
+            self.uploader.put_bytes(mirror, data.encode('utf-8'))
+
+    # rebuild the remote manifest from the server.
+    # every file in out_root is compared with it on next upload.
+    def verify_remote(self):
+        out_root = self.setting['out_root']
+        items = []
+        for path, size in self.uploader.walk_remote().items():
+            local_ = out_root + path
+            if os.path.isfile(local_) and os.path.getsize(local_) == size:
+                items.append((path, self.uploader.get_digest(path), size))
+        self.dbm.replace_remote_manifest(items)
+        cut_ = len(out_root)
+        everything = []
+        for root, dirs, files in os.walk(out_root):
+            everything += list(map(lambda x:
+                                    (root + '/' + x)[cut_:],
+                                    files))
+        self.dbm.add_pending(everything)
+        self.save_manifest()
             
-    # list up all paths from root to given path
-    def extract_path(self, path):
-        return list(reduce(lambda x, y:
-                            x.append(
-                                (x[-1]+os.sep+y).replace('//','/')
-                            ) or x,
-                            path.split(os.sep)[:-1],
-                            ['/']))[1:]
-    
-    def get_mtime(self, path):
-        return os.stat(self.setting['src_root'] + path).st_mtime
-    
+    # {path: (mtime, size)} of files in src_root by one walk,
+    # stat of each file is taken from its dir entry.
+    def scan(self):
+        src_root = str(pathlib.Path(self.setting['src_root']))
+        ignore_ = tuple(self.setting['ignore_files'])
+        stats = dict()
+        pending = ['']
+        while pending:
+            dir_ = pending.pop()
+            with os.scandir(src_root + dir_) as it:
+                for entry in it:
+                    path_ = dir_ + '/' + entry.name
+                    # symlinked dirs are neither walked nor listed
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(path_)
+                    elif entry.is_dir():
+                        continue
+                    elif self.is_source(path_, ignore_):
+                        st_ = entry.stat()
+                        stats[path_] = (st_.st_mtime, st_.st_size)
+        return stats
+
+    # ignored files are dropped without stat,
+    # but name files are watched for breadcrumbs and titles.
+    def is_source(self, path, ignore_):
+        return (not path.endswith(ignore_)
+                or self.deps.is_name_file(path))
+
     def make_symmetrical_dirs(self, dirs):
         # make dir in outdir (if its does not exists)
         base_path = self.setting['out_root'] + os.sep
@@ -195,76 +746,1151 @@ class SiteBuilder:
             if not os.path.exists(base_path + path_):
                 os.makedirs(base_path + path_)
 
+#
+# Build report
+#
+class BuildReport:
+    # cpu is of this process, worker processes are not included
+    def __init__(self):
+        # phase -> seconds
+        self.phases = dict()
+        self.cpu = dict()
+        self.counts = dict()
+        self.bytes = {'read': 0, 'written': 0, 'uploaded': 0, 'saved': 0}
+        # name of node -> [count, seconds]
+        self.nodes = dict()
+        # seconds to upload each file
+        self.latencies = []
+        self.lap_time = (time.perf_counter(), time.process_time())
+
+    # close the phase which has been going on since the last lap
+    def lap(self, phase):
+        now = (time.perf_counter(), time.process_time())
+        self.phases[phase] = now[0] - self.lap_time[0]
+        self.cpu[phase] = now[1] - self.lap_time[1]
+        self.lap_time = now
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def add_nodes(self, timings):
+        for name, (count, seconds) in timings.items():
+            total = self.nodes.setdefault(name, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+
+    def percentiles(self):
+        if not self.latencies:
+            return dict()
+        sorted_ = sorted(self.latencies)
+        result = dict(map(lambda x:
+                            (f'p{x}',
+                                sorted_[min(len(sorted_) - 1,
+                                            len(sorted_) * x // 100)]),
+                            (50, 90, 99)))
+        result['max'] = sorted_[-1]
+        return result
+
+    def as_dict(self):
+        return {
+            'phases': dict(map(lambda x:
+                                (x, {'wall': self.phases[x],
+                                     'cpu': self.cpu[x]}),
+                                self.phases)),
+            'counts': self.counts,
+            'bytes': self.bytes,
+            'nodes': dict(map(lambda x:
+                                (x[0], {'count': x[1][0],
+                                        'seconds': x[1][1]}),
+                                self.nodes.items())),
+            'upload_latency': self.percentiles()}
+
+    def write(self, path):
+        with open(path, mode='w') as fp:
+            json.dump(self.as_dict(), fp, indent=2)
+
+    def table(self):
+        lines = [f'{"phase":12}{"wall":>10}{"cpu":>10}']
+        lines += list(map(lambda x:
+                            f'{x:12}{self.phases[x]:10.3f}{self.cpu[x]:10.3f}',
+                            self.phases))
+        lines.append(f'{"total":12}{sum(self.phases.values()):10.3f}'
+                     f'{sum(self.cpu.values()):10.3f}')
+        lines.append('')
+        lines.append(' '.join(map(lambda x:
+                                    f'{x[0]}={x[1]}',
+                                    self.counts.items())))
+        lines.append(' '.join(map(lambda x:
+                                    f'{x[0]}={x[1]}B',
+                                    self.bytes.items())))
+        if self.nodes:
+            lines.append('')
+            lines.append(f'{"node":16}{"count":>8}{"seconds":>10}')
+            lines += list(map(lambda x:
+                                f'{x[0]:16}{x[1][0]:8}{x[1][1]:10.3f}',
+                                sorted(self.nodes.items(),
+                                        key=lambda x: -x[1][1])))
+        if self.latencies:
+            lines.append('')
+            lines.append('upload latency ' + ' '.join(map(lambda x:
+                                    f'{x[0]}={x[1] * 1000:.1f}ms',
+                                    self.percentiles().items())))
+        return '\n'.join(lines)
+
+#
+# Watch source files
+#
+class SourceWatcher:
+    # a dir is listed again only when its mtime changes,
+    # files are stat()ed on every poll (edits keep dir mtime).
+    def __init__(self, root):
+        self.root = str(pathlib.Path(root))
+        # dir -> (mtime, files, subdirs)
+        self.dirs = dict()
+        # path -> (mtime, size), same as SiteBuilder.scan
+        self.stats = dict()
+
+    # returns True if something changed since last poll
+    def poll(self):
+        dirs = dict()
+        stats = dict()
+        pending = ['']
+        while pending:
+            dir_ = pending.pop()
+            try:
+                mtime = os.stat(self.root + dir_).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            known = self.dirs.get(dir_)
+            if known is None or known[0] != mtime:
+                known = (mtime, ) + self.list_dir(dir_)
+            dirs[dir_] = known
+            pending += known[2]
+            for file in known[1]:
+                try:
+                    st_ = os.stat(self.root + file)
+                except FileNotFoundError:
+                    continue
+                stats[file] = (st_.st_mtime, st_.st_size)
+        changed = stats != self.stats
+        self.dirs = dirs
+        self.stats = stats
+        return changed
+
+    # (files, subdirs)
+    def list_dir(self, dir_):
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(self.root + dir_) as it:
+                for entry in it:
+                    # same as SiteBuilder.scan
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(dir_ + '/' + entry.name)
+                    elif not entry.is_dir():
+                        files.append(dir_ + '/' + entry.name)
+        except FileNotFoundError:
+            pass
+        return (files, subdirs)
+
+#
+# Preview server
+#
+class Previewer:
+    # rendered pages are kept until a source of them changes:
+    #   document: txt, name files of ancestors (breadcrumbs)
+    #   index: entries of the dir (titles, mtimes), name files of
+    #          subdirs and ancestors
+    # and the template, which TemplateCache compiles again if stale.
+    # variants of images ('a-480w.jpg', 'a.webp') are served by their
+    # source image, browsers read the type from the data.
+    variant_pattern = re.compile('^(.*?)(-[0-9]+w)?(\\.jpg|\\.jpeg|\\.webp)$')
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.setting = builder.setting
+        self.deps = builder.deps
+        # url path -> (stamp, template, html)
+        self.pages = dict()
+
+    # '/a/b.html' -> (content type, bytes), or None if not found
+    def get(self, path):
+        src_root = self.setting['src_root']
+        if path.endswith('/index.html'):
+            path = path[:-len('index.html')]
+        if path.endswith('/') and os.path.isdir(src_root + path):
+            dir_ = path.rstrip('/') or '/'
+            return self.page(path, dir_, 'index')
+        if path.endswith('.html'):
+            txt = path[:-4] + 'txt'
+            if os.path.isfile(src_root + txt):
+                return self.page(path, txt, 'document')
+        if (os.path.isfile(src_root + path)
+                and not self.deps.is_name_file(path)):
+            return self.file(path)
+        found = self.variant_pattern.search(path)
+        if found and (found.group(2) or found.group(3) == '.webp'):
+            for ext in ('.jpg', '.jpeg'):
+                if os.path.isfile(src_root + found.group(1) + ext):
+                    return self.file(found.group(1) + ext)
+        return None
+
+    def file(self, path):
+        type_ = mimetypes.guess_type(path)[0]
+        with open(self.setting['src_root'] + path, mode='rb') as fp:
+            return (type_ or 'application/octet-stream', fp.read())
+
+    def page(self, path, target, kind):
+        template_file = self.setting['templates'][kind]
+        templates = self.builder.templates
+        # check template files on every request
+        self.builder.generation += 1
+        templates.begin_build(self.builder.generation)
+        stamp = self.stamp(target, kind)
+        cached = self.pages.get(path)
+        if (cached and cached[0] == stamp
+                and cached[1] is templates.get(template_file)):
+            return ('text/html; charset=utf-8', cached[2])
+        if kind == 'document':
+            reg_time, mod_time = self.times(target)
+        else:
+            reg_time, mod_time = '-', '-'
+        publisher = Publisher(template_file, templates)
+        out = publisher.render(
+                src_root = self.setting['src_root'],
+                out_root = self.setting['out_root'],
+                target_path = target,
+                registered_time = reg_time,
+                modified_time = mod_time,
+                title_prefix = self.setting['site_name'] + ' - ')[1]
+        html = out.encode('utf-8')
+        self.pages[path] = (stamp, templates.get(template_file), html)
+        return ('text/html; charset=utf-8', html)
+
+    # (path, mtime) of every source of the page
+    def stamp(self, target, kind):
+        src_root = self.setting['src_root']
+        if kind == 'document':
+            dir_ = self.deps.parent_of(target)
+            sources = [target]
+        else:
+            dir_ = target
+            listing = self.deps.listing_of(dir_)
+            names = sorted(os.listdir(src_root + dir_))
+            sources = list(map(lambda x:
+                                listing + x,
+                                names))
+            sources += list(map(lambda x:
+                                self.deps.name_file_of(x),
+                                filter(lambda x:
+                                    os.path.isdir(src_root + x),
+                                    sources)))
+        sources += list(map(self.deps.name_file_of,
+                            self.deps.ancestors_of(dir_)))
+        return tuple(map(lambda x:
+                            (x, self.mtime_or_none(src_root + x)),
+                            sources))
+
+    def mtime_or_none(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    # dates of a document, from DB if it has been built
+    def times(self, target):
+        known = (self.builder.dbm.snapshot or dict()).get(target)
+        if known:
+            made, modified = known[0], known[1]
+        else:
+            made = modified = os.stat(
+                                self.setting['src_root'] + target).st_mtime
+        return tuple(map(lambda x:
+                            datetime.datetime.fromtimestamp(x).strftime(
+                                ContextManager.timestamp_format),
+                            (made, modified)))
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, *args, previewer=None, **kwargs):
+        self.previewer = previewer
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        path = urllib.parse.unquote(
+                    urllib.parse.urlsplit(self.path).path)
+        # stay in src_root
+        if '/../' in path + '/' or not path.startswith('/'):
+            self.send_error(403)
+            return
+        src_root = self.previewer.setting['src_root']
+        if not path.endswith('/') and os.path.isdir(src_root + path):
+            # relative links in index need trailing '/'
+            self.send_response(301)
+            self.send_header('Location', path + '/')
+            self.end_headers()
+            return
+        try:
+            found = self.previewer.get(path)
+        except Exception as e:
+            self.send_error(500, f'{type(e).__name__}: {e}')
+            return
+        if found is None:
+            self.send_error(404)
+            return
+        type_, body = found
+        self.send_response(200)
+        self.send_header('Content-Type', type_)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+#
+# Dependency tracking
+#
+class DependencyTracker:
+    # outputs are ('doc', path of txt) and ('index', path of dir).
+    # sources are paths of files, outputs, and paths of dirs with
+    # trailing '/' those stand for list of their entries.
+    def __init__(self, name_file='_name'):
+        self.name_file = name_file
+        self.dependents = dict()
+
+    def depends(self, output, source):
+        if source not in self.dependents:
+            self.dependents[source] = set()
+        self.dependents[source].add(output)
+
+    # record dependencies of every output from paths of sources,
+    # returns dirs those have index.
+    def record(self, paths):
+        self.dependents = dict()
+        for path in paths:
+            if self.is_name_file(path):
+                continue
+            index = ('index', self.parent_of(path))
+            if path.endswith('.txt'):
+                doc = ('doc', path)
+                self.depends(doc, path)
+                # breadcrumbs
+                for d in self.ancestors_of(self.parent_of(path)):
+                    self.depends(doc, self.name_file_of(d))
+                # title and size
+                self.depends(index, doc)
+            else:
+                # size and mtime
+                self.depends(index, path)
+        dirs = self.dirs_of(paths)
+        for dir_ in dirs:
+            index = ('index', dir_)
+            # breadcrumbs and title
+            for d in self.ancestors_of(dir_):
+                self.depends(index, self.name_file_of(d))
+            self.depends(index, self.listing_of(dir_))
+            if dir_ != '/':
+                # title and mtime of folder in index of parent
+                parent = ('index', self.parent_of(dir_))
+                self.depends(parent, self.name_file_of(dir_))
+                self.depends(parent, self.listing_of(dir_))
+        return dirs
+
+    # list of entries changes when a file is added or removed, and
+    # when a dir appears or disappears.
+    def changed_listings(self, paths, dirs_before, dirs_after):
+        result = set()
+        for path in paths:
+            result.add(self.listing_of(self.parent_of(path)))
+            for d in self.ancestors_of(self.parent_of(path))[1:]:
+                if (d in dirs_before) != (d in dirs_after):
+                    result.add(self.listing_of(self.parent_of(d)))
+        return list(result)
+
+    # outputs those depend on changed sources (directly or not).
+    # returns (paths of txt, paths of dir)
+    def affected(self, changed):
+        found = set()
+        stack = list(changed)
+        while stack:
+            for output in self.dependents.get(stack.pop(), ()):
+                if output not in found:
+                    found.add(output)
+                    stack.append(output)
+        docs = sorted(map(lambda x: x[1],
+                            filter(lambda x: x[0] == 'doc', found)))
+        dirs = sorted(map(lambda x: x[1],
+                            filter(lambda x: x[0] == 'index', found)))
+        return docs, dirs
+
+    def dirs_of(self, paths):
+        dirs = set()
+        for path in paths:
+            dirs.update(self.ancestors_of(self.parent_of(path)))
+        return dirs
+
+    # '/a/b' -> ['/', '/a', '/a/b']
+    def ancestors_of(self, dir_):
+        result = ['/']
+        for name in dir_.split('/')[1:]:
+            if name:
+                result.append(result[-1].rstrip('/') + '/' + name)
+        return result
+
+    def parent_of(self, path):
+        return path[:path.rfind('/')] or '/'
+
+    def name_file_of(self, dir_):
+        return dir_.rstrip('/') + '/' + self.name_file
+
+    def listing_of(self, dir_):
+        return dir_.rstrip('/') + '/'
+
+    def is_name_file(self, path):
+        return os.path.basename(path) == self.name_file
+
+
+#
+# Search index
+#
+class SearchIndex:
+    # files in out_root + search_index:
+    #   docs.json: {id: [url, title]}
+    #   <shard>.json: {term: [[id, count], ...]}
+    # a term goes to the shard of its first letter, a-z and 0-9 as
+    # they are, others to 'x' + hex of (code point % 64).
+    # words are lowercased, Japanese is split into bigrams.
+    cjk = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f'
+    token_pattern = re.compile(f'(?P<cjk>[{cjk}]+)|(?P<word>[^\\W_{cjk}]+)')
+    tag_pattern = re.compile('<[^>]*>')
+
+    def __init__(self, setting, dbm):
+        self.dir_ = '/' + setting['search_index'].strip('/')
+        self.out_root = setting['out_root']
+        self.dbm = dbm
+
+    # {term: count} of words in html
+    @classmethod
+    def terms_of(cls, html_):
+        text = html.unescape(cls.tag_pattern.sub(' ', html_)).lower()
+        terms = dict()
+        for found in cls.token_pattern.finditer(text):
+            run = found.group()
+            if found.lastgroup == 'cjk':
+                grams = list(map(lambda x:
+                                    run[x:x + 2],
+                                    range(max(1, len(run) - 1))))
+            elif len(run) > 1:
+                grams = [run]
+            else:
+                grams = []
+            for gram in grams:
+                terms[gram] = terms.get(gram, 0) + 1
+        return terms
+
+    # words of the document itself, without breadcrumbs, ToC and
+    # the heading of notes, those are made from other files.
+    @classmethod
+    def terms_of_text(cls, con):
+        terms = cls.terms_of(''.join(con.html[con.text_from:]))
+        if con.annotation_count:
+            terms['notes'] -= 1
+            if not terms['notes']:
+                del terms['notes']
+        return terms
+
+    # documents in paths not indexed yet (search_index turned on for
+    # a site built before), compiled as if they were modified
+    def missing(self, paths, docs):
+        indexed = self.dbm.get_search_paths()
+        docs_ = set(docs)
+        return sorted(filter(lambda x:
+                                x.endswith('.txt')
+                                    and x not in indexed
+                                    and x not in docs_,
+                                paths))
+
+    @staticmethod
+    def shard_of(term):
+        if term[0] in string.ascii_lowercase + string.digits:
+            return term[0]
+        return f'x{ord(term[0]) % 64:02x}'
+
+    # documents: [(txt, url, title, terms), ...] compiled again
+    # removed: txt removed from src_root
+    # returns files written (shards those have changed words in)
+    def update(self, documents, removed):
+        indexed = self.dbm.get_search_paths()
+        removed = list(filter(lambda x: x in indexed, removed))
+        shards = set(self.dbm.get_search_shards(removed))
+        docs_changed = bool(removed)
+        changed = []
+        for document in documents:
+            old = self.dbm.get_search_item(document[0])
+            if old is None or old[:2] != document[1:3]:
+                docs_changed = True
+            elif old[2] == document[3]:
+                continue
+            old_terms = old[2] if old else dict()
+            shards.update(map(self.shard_of,
+                                filter(lambda x:
+                                        old_terms.get(x) != document[3].get(x),
+                                        set(old_terms) | set(document[3]))))
+            changed.append(document)
+        if not (docs_changed or shards):
+            return []
+        documents = changed
+        self.dbm.remove_search_items(removed)
+        self.dbm.set_search_items(list(map(lambda x:
+                                    x[:3] + (list(map(lambda y:
+                                                (self.shard_of(y[0]), ) + y,
+                                                x[3].items())), ),
+                                    documents)))
+        os.makedirs(self.out_root + self.dir_, exist_ok=True)
+        written = []
+        if docs_changed:
+            written.append(self.write('docs.json', self.dbm.get_search_docs()))
+        for shard in sorted(shards):
+            postings = dict()
+            for term, id_, count in self.dbm.get_search_shard(shard):
+                postings.setdefault(term, []).append([id_, count])
+            written.append(self.write(f'{shard}.json', postings))
+        return written
+
+    def write(self, name, data):
+        path_ = f'{self.dir_}/{name}'
+        unlink_shared(self.out_root + path_)
+        with open(self.out_root + path_, mode='w', encoding='utf-8') as fp:
+            json.dump(data, fp, ensure_ascii=False,
+                      separators=(',', ':'), sort_keys=True)
+        return path_
+
+#
+# Sitemap and feed
+#
+class SiteMap:
+    # written from the DB, sources are not read again.
+    # sitemap over sitemap_urls pages is split into
+    # <name>-1.xml, <name>-2.xml, ... listed by a sitemap index.
+    def __init__(self, setting, dbm):
+        self.dbm = dbm
+        self.out_root = setting['out_root']
+        self.site_url = setting['site_url'].rstrip('/')
+        self.sitemap = None
+        if setting.get('sitemap'):
+            self.sitemap = '/' + setting['sitemap'].strip('/')
+        self.sitemap_urls = setting.get('sitemap_urls', 50000)
+        self.feed = None
+        if setting.get('feed'):
+            self.feed = '/' + setting['feed'].strip('/')
+        self.feed_entries = setting.get('feed_entries', 20)
+        self.feed_title = setting.get('feed_title', setting['site_name'])
+
+    # changed: pages or their timestamps are changed
+    # returns files written
+    def update(self, changed):
+        outputs = list(filter(None, (self.sitemap, self.feed)))
+        if not changed and all(map(lambda x:
+                                    os.path.isfile(self.out_root + x),
+                                    outputs)):
+            return []
+        written = []
+        if self.sitemap:
+            written += self.write_sitemap()
+        if self.feed:
+            written += self.write_feed()
+        return written
+
+    def url_of(self, path):
+        return self.site_url + urllib.parse.quote(path[:-4] + '.html')
+
+    @staticmethod
+    def w3c_time(timestamp):
+        return datetime.datetime.fromtimestamp(
+                    int(timestamp or 0),
+                    datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def write_sitemap(self):
+        count = self.dbm.count_documents()
+        chunks = max(1, -(-count // self.sitemap_urls))
+        base_ = self.sitemap[:-4] if self.sitemap.endswith('.xml') \
+                    else self.sitemap
+        written = []
+        # parts of a larger split are emptied, on the server too
+        n = chunks + 1 if chunks > 1 else 1
+        while os.path.isfile(f'{self.out_root}{base_}-{n}.xml'):
+            written += self.write(f'{base_}-{n}.xml', self.urlset([]))
+            n += 1
+        if chunks == 1:
+            return written + self.write(self.sitemap, self.urlset(
+                        self.dbm.get_documents(self.sitemap_urls, 0)))
+        index_ = []
+        for n in range(chunks):
+            rows = self.dbm.get_documents(
+                        self.sitemap_urls, n * self.sitemap_urls)
+            path_ = f'{base_}-{n + 1}.xml'
+            written += self.write(path_, self.urlset(rows))
+            index_.append(
+                f'<sitemap><loc>{html.escape(self.site_url + path_)}</loc>'
+                f'<lastmod>{self.w3c_time(max(map(lambda x: x[1] or 0, rows)))}</lastmod></sitemap>\n')
+        written += self.write(self.sitemap,
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                    + ''.join(index_) + '</sitemapindex>\n')
+        return written
+
+    # rows: [(path, modified), ...]
+    def urlset(self, rows):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                + ''.join(map(lambda x:
+                    f'<url><loc>{html.escape(self.url_of(x[0]))}</loc>'
+                    f'<lastmod>{self.w3c_time(x[1])}</lastmod></url>\n',
+                    rows))
+                + '</urlset>\n')
+
+    # documents made lately
+    def write_feed(self):
+        rows = self.dbm.get_recent_documents(self.feed_entries)
+        updated = self.w3c_time(max(map(lambda x: x[2] or 0, rows),
+                                    default=0))
+        entries = list(map(lambda x:
+                    '<entry>'
+                    f'<title>{html.escape(x[3] or x[0])}</title>'
+                    f'<link href="{html.escape(self.url_of(x[0]))}"/>'
+                    f'<id>{html.escape(self.url_of(x[0]))}</id>'
+                    f'<published>{self.w3c_time(x[1])}</published>'
+                    f'<updated>{self.w3c_time(x[2])}</updated>'
+                    '</entry>\n',
+                    rows))
+        feed_url = html.escape(self.site_url + self.feed)
+        return self.write(self.feed,
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                    f'<title>{html.escape(self.feed_title)}</title>\n'
+                    f'<link href="{html.escape(self.site_url)}/"/>\n'
+                    f'<link rel="self" href="{feed_url}"/>\n'
+                    f'<id>{feed_url}</id>\n'
+                    f'<updated>{updated}</updated>\n'
+                    f'<author><name>{html.escape(self.feed_title)}</name></author>\n'
+                    + ''.join(entries) + '</feed>\n')
+
+    # files with the same content are left as they are
+    def write(self, path_, text):
+        data = text.encode('utf-8')
+        if os.path.isfile(self.out_root + path_):
+            with open(self.out_root + path_, mode='rb') as fp:
+                if fp.read() == data:
+                    return []
+        os.makedirs(os.path.dirname(self.out_root + path_), exist_ok=True)
+        unlink_shared(self.out_root + path_)
+        with open(self.out_root + path_, mode='wb') as fp:
+            fp.write(data)
+        return [path_]
+
+#
+# Worker processes
+#
+worker_setting = dict()
+worker_publishers = dict()
+worker_templates = None
+worker_imagers = dict()
+
+# each worker gets the setting once
+def init_worker(setting):
+    global worker_templates
+    worker_setting.update(setting)
+    worker_templates = TemplateCache()
+    ImgNode.configure(setting)
+    Publisher.collect_terms = bool(setting.get('search_index'))
+
+# returns (output, parse time of nodes, (title, terms))
+def compile_worker(file, reg_time, mod_time, template, generation):
+    worker_templates.begin_build(generation)
+    RootNode.timings = dict()
+    result = call_publisher(
+                worker_publishers, worker_templates, worker_setting,
+                file, reg_time, mod_time, template)
+    return (result, RootNode.timings, worker_publishers[template].terms)
+
+def resize_worker(file):
+    if 'jpg' not in worker_imagers:
+        worker_imagers['jpg'] = ImageManager.from_setting(worker_setting)
+    return call_resizer(worker_imagers['jpg'], worker_setting, file)
+
+# returns (file, error message or None, outputs written).
+# a broken image does not stop the others.
+def call_resizer(im, setting, file):
+    try:
+        outputs = im.do_resize(
+                    setting['src_root'] + file,
+                    setting['out_root'] + file)
+    except Exception as e:
+        return (file, f'{type(e).__name__}: {e}', [])
+    return (file, None, list(map(lambda x:
+                                    x[len(setting['out_root']):],
+                                    outputs)))
+
+# an output may be a hard link to its source (copy_mode 'hardlink'),
+# it is unlinked before written so that the source is kept as it is.
+def unlink_shared(path):
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# write file.gz (and file.br) next to file, returns their paths.
+# (gzip without mtime, same content makes same sidecar)
+def write_sidecars(out_root, file, formats):
+    with open(out_root + file, mode='rb') as fp:
+        data = fp.read()
+    result = []
+    for format_ in formats:
+        if format_ == 'gz':
+            packed = gzip.compress(data, compresslevel=9, mtime=0)
+        else:
+            packed = brotli.compress(data)
+        unlink_shared(out_root + file + '.' + format_)
+        with open(out_root + file + '.' + format_, mode='wb') as fp:
+            fp.write(packed)
+        result.append(file + '.' + format_)
+    return result
+
+# one Publisher per template, reused for every file
+def call_publisher(publishers, templates, setting, file,
+                    reg_time='-', mod_time='-', template=''):
+    if template not in publishers:
+        publishers[template] = Publisher(template, templates)
+    result = publishers[template].publish(
+        src_root = setting['src_root'],
+        out_root = setting['out_root'],
+        target_path = file,
+        registered_time = reg_time,
+        modified_time = mod_time,
+        title_prefix = setting['site_name'] + ' - ')
+    return result
+
+
 #
 # SQLite3
 #
 class DBManager:
+    # columns: path, made, modified, size, mtime, digest
+    #   modified: when the content was changed last time
+    #   size, mtime: stat of the file when it was checked last time
+    #   digest: hash of the content (filled in 'hash' mode)
+    # and title of a document (not in the snapshot)
+    columns = ('path', 'made', 'modified', 'size', 'mtime', 'digest')
+
     def __init__(self, setting):
         self.db_file = setting['db_file']
         self.connection = sqlite3.connect(self.db_file)
         self.cursor = self.connection.cursor()
         self.site_name = setting['site_name']
         self.src_root = setting['src_root']
+        # 'mtime': a file is modified when it gets newer
+        # 'hash' : a file is modified when its content is changed
+        self.detection = setting.get('change_detection', 'mtime')
+        self.snapshot = None
+        self.digests = dict()
         try:
-            self.cursor.execute(f'CREATE TABLE [{site_name}] (path text, made integer, modified integer);')
+            self.cursor.execute(f'CREATE TABLE [{self.site_name}] (path text, made integer, modified integer, size integer, mtime integer, digest text, title text);')
         except:
-            pass
+            # tables made by older version have no stat columns
+            for column in ('size integer', 'mtime integer', 'digest text',
+                            'title text'):
+                try:
+                    self.cursor.execute(f'ALTER TABLE [{self.site_name}] ADD COLUMN {column};')
+                except:
+                    pass
+        self.cursor.execute(f'CREATE INDEX IF NOT EXISTS [{self.site_name}:path] ON [{self.site_name}] (path);')
+        # for the feed (documents made lately)
+        self.cursor.execute(f'CREATE INDEX IF NOT EXISTS [{self.site_name}:made] ON [{self.site_name}] (made);')
+        # what the server holds, and what is being uploaded
+        self.cursor.execute(f'CREATE TABLE IF NOT EXISTS [{self.site_name}:remote] (path text PRIMARY KEY, digest text, size integer);')
+        self.cursor.execute(f'CREATE TABLE IF NOT EXISTS [{self.site_name}:pending] (path text PRIMARY KEY);')
+        # search index: documents, and words in them
+        self.cursor.execute(f'CREATE TABLE IF NOT EXISTS [{self.site_name}:search] (id INTEGER PRIMARY KEY, path text UNIQUE, url text, title text);')
+        self.cursor.execute(f'CREATE TABLE IF NOT EXISTS [{self.site_name}:terms] (id integer, shard text, term text, count integer);')
+        self.cursor.execute(f'CREATE INDEX IF NOT EXISTS [{self.site_name}:terms:shard] ON [{self.site_name}:terms] (shard);')
+        self.cursor.execute(f'CREATE INDEX IF NOT EXISTS [{self.site_name}:terms:id] ON [{self.site_name}:terms] (id);')
+        # settings of ImageManager each image was made with
+        self.cursor.execute(f'CREATE TABLE IF NOT EXISTS [{self.site_name}:derived] (path text PRIMARY KEY, signature text);')
 
     def is_new(self, path):
-        query = f'SELECT * FROM [{self.site_name}] WHERE path="{path}";'
-        self.cursor.execute(query)
+        if self.snapshot is not None:
+            return path not in self.snapshot
+        query = f'SELECT * FROM [{self.site_name}] WHERE path=?;'
+        self.cursor.execute(query, (path, ))
         res = self.cursor.fetchall()
         return True if len(res) == 0 else False
 
     def is_modified(self, path):
         mtime = os.stat(self.src_root + path).st_mtime
-        query = f'SELECT * FROM [{self.site_name}] WHERE path="{path}";'
-        self.cursor.execute(query)
-        res = self.cursor.fetchone()
-        last_modified = list(res)[-1]
-        if mtime > last_modified:
-            return True
-        else:
-            return False
+        return mtime > self.get_modified_time(path)
 
     def update_item(self, path, mtime):
-        query = f'UPDATE [{self.site_name}] SET modified=? WHERE path=?;'
-        dat= (mtime, path)
-        self.cursor.execute(query, dat)
-        self.connection.commit()
+        self.update_items([(path, mtime, None, mtime, None)])
 
     def add_item(self, path, made, modified):
-        query = f'INSERT INTO [{self.site_name}] values (?, ?, ?);'
-        dat = (path, made, modified)
-        self.cursor.execute(query, dat)
-        self.connection.commit()
+        self.add_items([(path, made, modified, None, modified, None)])
 
-    def get_made_time(self, path):
-        query = f'SELECT * FROM [{self.site_name}] WHERE path="{path}";'
+    # bulk snapshot mode:
+    #   read every row with one query, then answer from memory
+    def load_snapshot(self):
+        query = f'SELECT {", ".join(self.columns)} FROM [{self.site_name}];'
+        self.cursor.execute(query)
+        self.snapshot = dict(map(lambda x:
+                                    (x[0], x[1:]),
+                                    self.cursor.fetchall()))
+        return self.snapshot
+
+    # sort {path: (mtime, size)} out into
+    #   new files, modified files and touched files.
+    # touched files have new stat but same content ('hash' mode only).
+    def classify(self, stats):
+        if self.snapshot is None:
+            self.load_snapshot()
+        new_files = []
+        mod_files = []
+        touched = []
+        for path, (mtime, size) in stats.items():
+            row = self.snapshot.get(path)
+            if row is None:
+                new_files.append(path)
+                if self.detection == 'hash':
+                    self.digests[path] = self.digest(self.src_root + path)
+            elif self.detection != 'hash':
+                if mtime > row[1]:
+                    mod_files.append(path)
+            else:
+                made, modified, size_, mtime_, digest_ = row
+                if mtime_ is None:
+                    mtime_ = modified
+                # check stat first, hash only files whose stat changed
+                if mtime == mtime_ and size == size_:
+                    continue
+                if digest_ is None and mtime <= modified:
+                    # row of older version: take the digest only
+                    self.digests[path] = self.digest(self.src_root + path)
+                    touched.append(path)
+                    continue
+                self.digests[path] = self.digest(self.src_root + path)
+                if self.digests[path] == digest_:
+                    touched.append(path)
+                else:
+                    mod_files.append(path)
+        return new_files, mod_files, touched
+
+    # fast content digest
+    @staticmethod
+    def digest(file, chunk_size=1 << 20):
+        h = hashlib.blake2b(digest_size=16)
+        with open(file, mode='rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # items: [(path, modified, size, mtime, digest), ...]
+    #   -- written in one transaction
+    def update_items(self, items):
+        query = f'UPDATE [{self.site_name}] SET modified=?, size=?, mtime=?, digest=? WHERE path=?;'
+        dat = list(map(lambda x: x[1:] + x[:1], items))
+        with self.connection:
+            self.cursor.executemany(query, dat)
+        if self.snapshot is not None:
+            for path, modified, size, mtime, digest in items:
+                made = self.snapshot[path][0]
+                self.snapshot[path] = (made, modified, size, mtime, digest)
+
+    # items: [(path, mtime, size), ...]
+    #   -- update stat (and digest) but keep modified time
+    def touch_items(self, items):
+        query = f'UPDATE [{self.site_name}] SET size=?, mtime=?, digest=? WHERE path=?;'
+        dat = list(map(lambda x:
+                        (x[2], x[1], self.digests.get(x[0]), x[0]),
+                        items))
+        with self.connection:
+            self.cursor.executemany(query, dat)
+        if self.snapshot is not None:
+            for path, mtime, size in items:
+                row = self.snapshot[path]
+                self.snapshot[path] = (row[0], row[1], size, mtime,
+                                        self.digests.get(path))
+
+    def remove_items(self, paths):
+        query = f'DELETE FROM [{self.site_name}] WHERE path=?;'
+        with self.connection:
+            self.cursor.executemany(query, map(lambda x: (x, ), paths))
+        if self.snapshot is not None:
+            for path in paths:
+                self.snapshot.pop(path, None)
+
+    # items: [(path, made, modified, size, mtime, digest), ...]
+    #   -- written in one transaction
+    def add_items(self, items):
+        query = f'INSERT INTO [{self.site_name}] ({", ".join(self.columns)}) values (?, ?, ?, ?, ?, ?);'
+        with self.connection:
+            self.cursor.executemany(query, items)
+        if self.snapshot is not None:
+            for item in items:
+                self.snapshot[item[0]] = item[1:]
+
+    # items: [(path, title), ...]
+    def set_titles(self, items):
+        query = f'UPDATE [{self.site_name}] SET title=? WHERE path=?;'
+        with self.connection:
+            self.cursor.executemany(query, map(lambda x: x[::-1], items))
+
+    def count_documents(self):
+        self.cursor.execute(f"SELECT COUNT(*) FROM [{self.site_name}] WHERE path LIKE '%.txt';")
+        return self.cursor.fetchone()[0]
+
+    # [(path, modified), ...] in order of path
+    def get_documents(self, limit, offset=0):
+        self.cursor.execute(f"SELECT path, modified FROM [{self.site_name}] WHERE path LIKE '%.txt' ORDER BY path LIMIT ? OFFSET ?;", (limit, offset))
+        return self.cursor.fetchall()
+
+    # [(path, made, modified, title), ...] newer first
+    def get_recent_documents(self, limit):
+        self.cursor.execute(f"SELECT path, made, modified, title FROM [{self.site_name}] WHERE path LIKE '%.txt' ORDER BY made DESC, path LIMIT ?;", (limit, ))
+        return self.cursor.fetchall()
+
+    # remote manifest: {path: digest}
+    def get_remote_manifest(self):
+        query = f'SELECT path, digest FROM [{self.site_name}:remote];'
         self.cursor.execute(query)
+        return dict(self.cursor.fetchall())
+
+    # items: [(path, digest, size), ...]
+    def set_remote_items(self, items):
+        query = f'INSERT OR REPLACE INTO [{self.site_name}:remote] values (?, ?, ?);'
+        with self.connection:
+            self.cursor.executemany(query, items)
+
+    def replace_remote_manifest(self, items):
+        with self.connection:
+            self.cursor.execute(f'DELETE FROM [{self.site_name}:remote];')
+            self.cursor.executemany(
+                f'INSERT INTO [{self.site_name}:remote] values (?, ?, ?);',
+                items)
+
+    # shards which have words of the documents
+    def get_search_shards(self, paths):
+        query = f'SELECT DISTINCT shard FROM [{self.site_name}:terms] WHERE id=(SELECT id FROM [{self.site_name}:search] WHERE path=?);'
+        result = set()
+        for path in paths:
+            self.cursor.execute(query, (path, ))
+            result.update(map(lambda x: x[0], self.cursor.fetchall()))
+        return result
+
+    def get_search_paths(self):
+        self.cursor.execute(f'SELECT path FROM [{self.site_name}:search];')
+        return set(map(lambda x: x[0], self.cursor.fetchall()))
+
+    # (url, title, {term: count}) or None
+    def get_search_item(self, path):
+        self.cursor.execute(f'SELECT id, url, title FROM [{self.site_name}:search] WHERE path=?;', (path, ))
+        res = self.cursor.fetchone()
+        if res is None:
+            return None
+        self.cursor.execute(f'SELECT term, count FROM [{self.site_name}:terms] WHERE id=?;', (res[0], ))
+        return (res[1], res[2], dict(self.cursor.fetchall()))
+
+    # items: [(path, url, title, [(shard, term, count), ...]), ...]
+    def set_search_items(self, items):
+        with self.connection:
+            for path, url, title, terms in items:
+                self.cursor.execute(f'INSERT OR IGNORE INTO [{self.site_name}:search] (path) values (?);', (path, ))
+                self.cursor.execute(f'UPDATE [{self.site_name}:search] SET url=?, title=? WHERE path=?;', (url, title, path))
+                self.cursor.execute(f'SELECT id FROM [{self.site_name}:search] WHERE path=?;', (path, ))
+                id_ = self.cursor.fetchone()[0]
+                self.cursor.execute(f'DELETE FROM [{self.site_name}:terms] WHERE id=?;', (id_, ))
+                self.cursor.executemany(
+                    f'INSERT INTO [{self.site_name}:terms] values (?, ?, ?, ?);',
+                    map(lambda x: (id_, ) + x, terms))
+
+    def remove_search_items(self, paths):
+        with self.connection:
+            for path in paths:
+                self.cursor.execute(f'DELETE FROM [{self.site_name}:terms] WHERE id=(SELECT id FROM [{self.site_name}:search] WHERE path=?);', (path, ))
+                self.cursor.execute(f'DELETE FROM [{self.site_name}:search] WHERE path=?;', (path, ))
+
+    # {id: [url, title]}
+    def get_search_docs(self):
+        self.cursor.execute(f'SELECT id, url, title FROM [{self.site_name}:search];')
+        return dict(map(lambda x:
+                            (x[0], [x[1], x[2]]),
+                            self.cursor.fetchall()))
+
+    # [(term, id, count), ...]
+    def get_search_shard(self, shard):
+        self.cursor.execute(f'SELECT term, id, count FROM [{self.site_name}:terms] WHERE shard=? ORDER BY term, id;', (shard, ))
+        return self.cursor.fetchall()
+
+    def get_derived(self):
+        self.cursor.execute(f'SELECT path, signature FROM [{self.site_name}:derived];')
+        return dict(self.cursor.fetchall())
+
+    # items: [(path, signature), ...]
+    def set_derived(self, items):
+        query = f'INSERT OR REPLACE INTO [{self.site_name}:derived] values (?, ?);'
+        with self.connection:
+            self.cursor.executemany(query, items)
+
+    def get_pending(self):
+        self.cursor.execute(f'SELECT path FROM [{self.site_name}:pending];')
+        return list(map(lambda x: x[0], self.cursor.fetchall()))
+
+    def add_pending(self, paths):
+        query = f'INSERT OR IGNORE INTO [{self.site_name}:pending] values (?);'
+        with self.connection:
+            self.cursor.executemany(query, map(lambda x: (x, ), paths))
+
+    def remove_pending(self, paths):
+        query = f'DELETE FROM [{self.site_name}:pending] WHERE path=?;'
+        with self.connection:
+            self.cursor.executemany(query, map(lambda x: (x, ), paths))
+
+    def get_made_time(self, path):
+        if self.snapshot is not None:
+            return self.snapshot[path][0]
+        query = f'SELECT made FROM [{self.site_name}] WHERE path=?;'
+        self.cursor.execute(query, (path, ))
         res = self.cursor.fetchone()
-        made_time = list(res)[1]
+        made_time = res[0]
         return made_time
 
     def get_modified_time(self, path):
-        query = f'SELECT * FROM [{self.site_name}] WHERE path="{path}"'
-        self.cursor.execute(query)
+        if self.snapshot is not None:
+            return self.snapshot[path][1]
+        query = f'SELECT modified FROM [{self.site_name}] WHERE path=?;'
+        self.cursor.execute(query, (path, ))
         res = self.cursor.fetchone()
-        mod_time = list(res)[2]
+        mod_time = res[0]
         return mod_time
 
 
+#
+# Templates
+#
+class CompiledTemplate:
+    def __init__(self, segments, files):
+        # literal, name, literal, name, ..., literal
+        self.segments = segments
+        # {path: mtime} of the template and its partials
+        self.files = files
+
+    # same result as string.Template(...).substitute(mapping)
+    def render(self, mapping):
+        parts = list(self.segments)
+        parts[1::2] = map(lambda x:
+                            str(mapping[x]),
+                            self.segments[1::2])
+        return ''.join(parts)
+
+
+class TemplateCache:
+    # ${include:head.html} is replaced with the partial, path is
+    # relative to the file which includes it.
+    include_pattern = re.compile(r'\$\{include:([^}]+)\}')
+
+    def __init__(self):
+        self.templates = dict()
+        self.checked = set()
+        self.generation = None
+
+    # forget checks of mtime when a new build begins
+    def begin_build(self, generation):
+        if generation != self.generation:
+            self.generation = generation
+            self.checked = set()
+
+    def get(self, path):
+        template = self.templates.get(path)
+        if path not in self.checked:
+            if template is None or self.is_stale(template):
+                template = self.compile(path)
+                self.templates[path] = template
+            self.checked.add(path)
+        return template
+
+    def is_stale(self, template):
+        for file, mtime in template.files.items():
+            try:
+                if os.stat(file).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def compile(self, path):
+        files = dict()
+        text = self.load(path, files, ())
+        delimiter = string.Template.delimiter
+        segments = ['']
+        pos = 0
+        for found in string.Template.pattern.finditer(text):
+            segments[-1] += text[pos:found.start()]
+            pos = found.end()
+            name = found.group('named') or found.group('braced')
+            if name is not None:
+                segments += [name, '']
+            elif found.group('escaped') is not None:
+                segments[-1] += delimiter
+            else:
+                lines = text[:found.start('invalid')].split('\n')
+                raise ValueError(f'Invalid placeholder in {path}: '
+                                 f'line {len(lines)}, col {len(lines[-1]) + 1}')
+        segments[-1] += text[pos:]
+        return CompiledTemplate(segments, files)
+
+    # read the file with its partials
+    def load(self, path, files, including):
+        if path in including:
+            raise ValueError(f'{path} is included recursively')
+        files[path] = os.stat(path).st_mtime
+        with open(path, encoding='utf-8') as fp:
+            text = fp.read()
+        base_ = os.path.dirname(path)
+        return self.include_pattern.sub(lambda x:
+                                            self.load(
+                                                os.path.join(base_, x.group(1).strip()),
+                                                files,
+                                                including + (path, )),
+                                            text)
+
+
 #
 # Publish html file
 #
 class Publisher:
-    def __init__(self, template_file=None):
+    h1_pattern = re.compile('<h1[^>\n]*>([^<\n]+)</h1>')
+    # (title, terms) of the last document goes to self.terms,
+    # terms are None unless collect_terms
+    collect_terms = False
+    terms = None
+
+    def __init__(self, template_file=None, templates=None):
         if template_file:
             self.template_file = template_file
-        with open(self.template_file, encoding='utf-8') as fp:
-            self.template_str = fp.read()
+        if templates is None:
+            templates = TemplateCache()
+        self.templates = templates
 
     def publish(self, src_root, out_root, target_path,
+        registered_time='1999/01/01', modified_time='1999/01/01',
+        title_prefix='', indent_str=' ', indent_level=2):
+        result, out = self.render(
+                        src_root, out_root, target_path,
+                        registered_time, modified_time,
+                        title_prefix, indent_str, indent_level)
+        unlink_shared(out_root + result)
+        with open(out_root + result, mode='w', encoding='utf-8') as fp:
+            fp.write(out)
+        return result
+
+    # returns (path of output, html) without writing it
+    def render(self, src_root, out_root, target_path,
         registered_time='1999/01/01', modified_time='1999/01/01',
         title_prefix='', indent_str=' ', indent_level=2):
         if os.path.isfile(src_root + target_path):
@@ -274,12 +1900,16 @@ class Publisher:
             con = ContextManager(
                         text=text,
                         path=target_path,
+                        src=src_root,
+                        out=out_root,
                         indent_str=indent_str,
                         indent_level=indent_level)
             out_name = target_path.split('/')[-1][:-3] + '.html'
         else:
             con = ContextManager(
                         path=target_path,
+                        src=src_root,
+                        out=out_root,
                         indent_str=indent_str,
                         indent_level=indent_level)
             out_name = 'index.html'
@@ -287,64 +1917,126 @@ class Publisher:
         node.parse()
 
         # generate html body
-        if len(con.toc_buffer.split('\n')) > 3:
-            buf = con.toc_buffer
-            toc = ContextManager(text=con.toc_buffer)
+        body = con.getvalue()
+        if len(con.toc_buffer) > 2:
+            toc = ContextManager(text=''.join(con.toc_buffer))
             toc.bread = True
             toc_node = TocNode(toc)
             toc_node.parse()
-            idx = 0
-            for l in con.html:
-                if '<h2' in l:
-                    break
-                idx += 1
-            con.html[idx:idx] = toc.html
-        body = '\n'.join(con.html)
+            # put ToC on the line before the first h2
+            pos = body.find('<h2')
+            if pos < 0:
+                body = body + '\n' + toc.getvalue()
+            else:
+                pos = body.rfind('\n', 0, pos) + 1
+                body = body[:pos] + toc.getvalue() + '\n' + body[pos:]
 
         # chimera with template
-        h1_pattern = re.compile('<h1[^>]*>([^<]+)</h1>')
+        #   (first h1 in a line)
         title = 'Untitled Document'
-        for l in con.html:
-            if h1_pattern.search(l):
-                title = h1_pattern.search(l).groups()[0].strip()
-                break
-        t = string.Template(self.template_str)
+        found = self.h1_pattern.search(body)
+        if found:
+            title = found.groups()[0].strip()
+        self.terms = None
+        if con.text is not None:
+            self.terms = (html.unescape(title),
+                          SearchIndex.terms_of_text(con)
+                                if self.collect_terms else None)
+        t = self.templates.get(self.template_file)
         d = {
           'title': f'{title_prefix}{title}',
           'body': body,
           'registered': registered_time,
           'modified': modified_time
         }
-        out = t.substitute(d)
+        out = t.render(d)
 
         # detect output path
         if out_name == 'index.html':
-            path_ = out_root + target_path + os.sep + out_name
             result = target_path + os.sep + out_name
         else:
-            path_ = out_root + target_path[:-3] + 'html'
             result = target_path[:-3] + 'html'
-
-        with open(path_, mode='w', encoding='utf-8') as fp:
-            fp.write(out)
-        return result
+        return result, out
 
 
 class ImageManager:
-    def __init__(self, max_length, quality=80):
+    # widths: smaller variants, 'a.jpg' -> 'a-480w.jpg'
+    # webp: WebP of each, 'a.jpg' -> 'a.webp', 'a-480w.webp'
+    # cache_dir: outputs are kept by digest of source and settings,
+    #            a moved or renamed image is not decoded again.
+    # lossless: also 'png', 'gif'. kept only when made smaller.
+    # colors: palette size png and gif are quantized to (0: as is)
+    def __init__(self, max_length, quality=80, widths=(), webp=False,
+                 cache_dir=None, lossless=(), colors=0):
         self.max_length = max_length
         self.quality = quality
+        self.widths = sorted(widths, reverse=True)
+        self.webp = webp
+        self.cache_dir = cache_dir
+        self.lossless = tuple(map(lambda x: '.' + x, lossless))
+        self.colors = colors
+
+    @classmethod
+    def from_setting(cls, setting):
+        return cls(
+            setting['img_max_length'],
+            quality=setting.get('img_quality', 80),
+            widths=setting.get('img_widths', []),
+            webp=setting.get('img_webp', False),
+            cache_dir=setting.get('image_cache'),
+            lossless=setting.get('img_optimize', []),
+            colors=setting.get('img_colors', 0))
+
+    def handles(self, path):
+        return path.endswith(('jpg', '.jpeg') + self.lossless)
+
+    @staticmethod
+    def is_jpg(path):
+        return path.endswith(('jpg', '.jpeg'))
+
+    # outputs of path change when this changes
+    # (settings of the other formats do not count)
+    def signature(self, path):
+        if not self.is_jpg(path):
+            return f'{self.max_length}-c{self.colors}'
+        widths = ','.join(map(str, self.widths))
+        return (f'{self.max_length}-q{self.quality}-w{widths}'
+                f'-webp{int(self.webp)}')
+
+    @staticmethod
+    def variant_of(path, width=None, ext=None):
+        base_, ext_ = os.path.splitext(path)
+        if width:
+            base_ += f'-{width}w'
+        return base_ + (ext or ext_)
+
+    # variants written next to the output of path.
+    # with width of the output, only narrower ones are made.
+    def variants_of(self, path, width_=None):
+        if not self.is_jpg(path):
+            return []
+        result = []
+        for width in [None] + self.widths:
+            if width and width_ and width >= width_:
+                continue
+            if width:
+                result.append(self.variant_of(path, width))
+            if self.webp:
+                result.append(self.variant_of(path, width, '.webp'))
+        return result
         
     def get_rotation_info(self):
         try:
             exif = self.img._getexif()
         except :
             return 0
+        if not exif:
+            return 0
         meta_data = dict()
         for tag_id, value in exif.items():
             tag = PIL.ExifTags.TAGS.get(tag_id, tag_id)
             meta_data[tag] = value
-        angle = meta_data['Orientation']
+        angle = meta_data.get('Orientation', 1)
         if angle == 1 or angle == 2:
             rotate = 0
         elif angle ==  8 or angle == 7:
@@ -369,47 +2061,154 @@ class ImageManager:
             w = int(org_w * h / org_h)
         return (w, h)
         
-    def decide_tmp_size(self):
-        org_w = self.img.width
-        org_h = self.img.height
-        
-        # decide output size from size of original image
-        if org_w < self.max_length and org_h < self.max_length:
-            return False
-        elif org_w > org_h:
-            h = int(org_h * self.max_length / org_w + 2)
-            w = int(org_w * h / org_h)
-        else:
-            h = self.max_length
-            w = int(org_w * self.max_length / org_h + 2)
-            h = int(org_h * w / org_w)
-        return (w, h)
-        
+    # (width, height) of the output of org_path, from its header
+    def output_size(self, org_path):
+        with PIL.Image.open(org_path) as self.img:
+            w, h = self.decide_output_size()
+            if self.get_rotation_info() in (90, 270):
+                return (h, w)
+            return (w, h)
+
+    # returns outputs written
     def do_resize(self, org_path, out_path):
-        self.img = PIL.Image.open(org_path)
-        r = self.get_rotation_info()
-        output_size = self.decide_output_size()
-        tmp_size = self.decide_tmp_size()
-        if r > 0:
-            self.img = self.img.rotate(r, expand=True)
-        if r == 90 or r == 270:
-            tmp_size = (tmp_size[1], tmp_size[0])
-            output_size = (output_size[1], output_size[0])
-        if tmp_size:
-            self.img = self.img.resize(tmp_size, PIL.Image.LANCZOS)
-        if output_size:
-            if not tmp_size:
-                tmp_size = output_size
-            x1 = int((tmp_size[0] - output_size[0]) / 2)
-            y1 = int((tmp_size[1] - output_size[1]) / 2)
-            x2 = x1 + output_size[0]
-            y2 = y1 + output_size[1]
-            self.img = self.img.crop((x1, y1, x2, y2))
-        with PIL.Image.new(self.img.mode, self.img.size) as out_img:
-            out_img.putdata(self.img.getdata())
-            out_img.save(out_path)
+        if self.is_jpg(org_path):
+            encode = self.encode
+            width = self.output_size(org_path)[0]
+        else:
+            encode = self.encode_lossless
+            width = None
+        for out_ in [out_path] + self.variants_of(out_path):
+            unlink_shared(out_)
+        written = [out_path] + self.variants_of(out_path, width)
+        if self.cache_dir is None:
+            encode(org_path, out_path)
+            return written
+        outputs = self.cached_outputs(
+                    DBManager.digest(org_path), out_path, width)
+        missing = list(filter(lambda x: not os.path.isfile(x[1]), outputs))
+        for out_, cached in outputs:
+            if (out_, cached) not in missing:
+                shutil.copyfile(cached, out_)
+        if not missing:
+            return written
+        if len(missing) == len(outputs):
+            encode(org_path, out_path)
+        else:
+            # a width added: the rest are in the cache
+            self.encode(org_path, out_path,
+                        set(map(lambda x: x[0], missing)))
+        for out_, cached in missing:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # other workers may read it, so it appears at once
+            tmp_ = f'{cached}.{os.getpid()}.tmp'
+            shutil.copyfile(out_, tmp_)
+            os.replace(tmp_, cached)
+        return written
+
+    # [(output, file in cache), ...] of main image and variants
+    #   cache: cache_dir/ab/abcd...-1280-q80-480w.webp
+    def cached_outputs(self, digest, out_path, width_=None):
+        if not self.is_jpg(out_path):
+            key_ = os.path.join(
+                        self.cache_dir, digest[:2],
+                        f'{digest}-{self.max_length}-c{self.colors}'
+                        f'{os.path.splitext(out_path)[1]}')
+            return [(out_path, key_)]
+        key_ = os.path.join(
+                    self.cache_dir, digest[:2],
+                    f'{digest}-{self.max_length}-q{self.quality}.jpg')
+        result = [(out_path, key_)]
+        for width in [None] + self.widths:
+            if width and width_ and width >= width_:
+                continue
+            if width:
+                result.append((self.variant_of(out_path, width),
+                                self.variant_of(key_, width)))
+            if self.webp:
+                result.append((self.variant_of(out_path, width, '.webp'),
+                                self.variant_of(key_, width, '.webp')))
+        return result
+
+    # only: outputs to write (the main one and variants), all if None
+    def encode(self, org_path, out_path, only=None):
+        # open() reads the header only, EXIF comes from there too
+        with PIL.Image.open(org_path) as self.img:
+            r = self.get_rotation_info()
+            output_size = self.decide_output_size()
+            if (r == 0 and output_size == self.img.size
+                    and self.img.format == 'JPEG'):
+                # small enough and upright: pass through byte-for-byte
+                if only is None or out_path in only:
+                    shutil.copyfile(org_path, out_path)
+                if self.variants_of(out_path):
+                    self.save_variants(self.img, out_path, only)
+                return True
+            if output_size != self.img.size:
+                # let the JPEG decoder scale down by 1/2, 1/4 or 1/8
+                self.img.draft(self.img.mode, output_size)
+                img = self.img.resize(output_size, PIL.Image.LANCZOS)
+            else:
+                img = self.img
+            if r > 0:
+                img = img.rotate(r, expand=True)
+            if only is None or out_path in only:
+                img.save(out_path, format='JPEG', quality=self.quality)
+            # from the same decoded image
+            self.save_variants(img, out_path, only)
         return True
 
+    # png and gif: shrink, quantize and save with optimized
+    # compression. the source is copied if it is smaller.
+    def encode_lossless(self, org_path, out_path):
+        with PIL.Image.open(org_path) as self.img:
+            format_ = self.img.format
+            if getattr(self.img, 'is_animated', False):
+                # frames are not handled
+                shutil.copyfile(org_path, out_path)
+                return True
+            img = self.img
+            output_size = self.decide_output_size()
+            if output_size != img.size:
+                if img.mode in ('P', 'PA', '1'):
+                    # palette can not be resampled
+                    img = img.convert('RGBA')
+                img = img.resize(output_size, PIL.Image.LANCZOS)
+            if self.colors and img.mode not in ('P', '1', 'L'):
+                # LA, PA and color keyed RGB keep their transparency
+                if 'A' in img.getbands() or 'transparency' in img.info:
+                    img = img.convert('RGBA').quantize(
+                            self.colors,
+                            method=PIL.Image.Quantize.FASTOCTREE)
+                else:
+                    img = img.convert('RGB').quantize(self.colors)
+            buf = io.BytesIO()
+            img.save(buf, format=format_, optimize=True)
+        if buf.tell() < os.path.getsize(org_path):
+            with open(out_path, mode='wb') as fp:
+                fp.write(buf.getvalue())
+        else:
+            shutil.copyfile(org_path, out_path)
+        return True
+
+    # each width is made from the next larger one.
+    # widths not narrower than the image are not made.
+    def save_variants(self, img, out_path, only=None):
+        def save(path, format_):
+            if only is None or path in only:
+                img.save(path, format=format_, quality=self.quality)
+        if self.webp:
+            save(self.variant_of(out_path, None, '.webp'), 'WEBP')
+        for width in self.widths:
+            if width < img.width:
+                img = img.resize(
+                        (width, max(1, round(img.height * width / img.width))),
+                        PIL.Image.LANCZOS)
+            else:
+                continue
+            save(self.variant_of(out_path, width), 'JPEG')
+            if self.webp:
+                save(self.variant_of(out_path, width, '.webp'), 'WEBP')
+
 
 #
 # Upload files via FTP
@@ -417,50 +2216,339 @@ class ImageManager:
 class Uploader:
     ascii_ext = ('css', 'html', 'js', 'txt', 'py', 'md', 'htaccess')
     binary_ext = ('zip', 'jpg', 'jpeg', 'png', 'gif', )
+    # connection is made again on these errors
+    retry_errors = (OSError, EOFError, ftplib.error_temp)
 
-    def __init__(self, setting):
+    def __init__(self, setting, ftp_class=ftplib.FTP):
         self.setting = setting
-        self.ftp = ftplib.FTP()
-        self.ftp.connect(
-            host=setting['server_info']['address'],
-            port=setting['server_info']['port'])
-        self.ftp.login(
-            user=setting['server_info']['username'],
-            passwd=setting['server_info']['password'])
-        self.ftp.cwd(setting['server_info']['working_directory'])
+        self.ftp_class = ftp_class
+        self.connections = setting.get('upload_connections', 1)
+        self.retries = setting.get('upload_retries', 2)
+        self.timeout = setting.get('upload_timeout', 60)
+        # SITE CHMOD for new dirs and files
+        self.chmod = setting.get('remote_chmod', True)
+        self.lock = threading.Lock()
+        # connected at first use
+        self.ftp = None
+        self.summary = dict()
+        # remote tree learned in this session. paths are relative to
+        # working directory ('' is working directory itself).
+        #   remote_dirs: dirs known to exist
+        #   remote_files: {dir: names of files in it} of listed dirs
+        self.remote_dirs = {''}
+        self.remote_files = dict()
+        self.tree_lock = threading.Lock()
+        # connections of upload() are parked here for the next one
+        self.idle = []
+        # files waiting for a connection, put() blocks when full
+        self.queue_size = setting.get(
+                            'upload_queue', self.connections * 4)
+        self.threads = None
+
+    # new connection parked in working directory
+    def open_connection(self):
+        info_ = self.setting['server_info']
+        ftp = self.ftp_class()
+        ftp.connect(
+            host=info_['address'],
+            port=info_['port'],
+            timeout=self.timeout)
+        ftp.login(
+            user=info_['username'],
+            passwd=info_['password'])
+        ftp.cwd(info_['working_directory'])
+        return ftp
+
+    def close_connection(self, ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def close(self):
+        if self.ftp is not None:
+            self.close_connection(self.ftp)
+            self.ftp = None
+        for ftp in self.idle:
+            self.close_connection(ftp)
+        self.idle = []
 
     def mirroring_file(self, target):
-        path = target.split('/')
-        for folder in path[:-1]:
-            flag_ = False
-            if folder == '':
+        return self.store(self.main_connection(), target)
+
+    # upload files over a pool of connections.
+    # on_done gets lists of uploaded files, called in this thread.
+    def upload(self, files, on_done=None):
+        self.start(on_done)
+        for file in files:
+            self.put(file)
+        return self.finish()
+
+    # files are given by put() while they are being uploaded
+    def start(self, on_done=None):
+        self.work = queue.Queue(maxsize=self.queue_size)
+        self.done = queue.Queue()
+        self.on_done = on_done
+        self.batch = []
+        self.reported = time.perf_counter()
+        self.summary = {
+            'files': 0, 'bytes': 0, 'seconds': 0.0, 'connections': 0,
+            'reconnects': 0, 'failed': [], 'latencies': []}
+        self.started = time.perf_counter()
+        self.threads = list(map(lambda x:
+                                threading.Thread(
+                                    target=self.__upload_worker,
+                                    args=(self.work, self.done),
+                                    # do not keep an interrupted build
+                                    daemon=True),
+                                range(self.connections)))
+        for t in self.threads:
+            t.start()
+
+    def running(self):
+        return self.threads is not None
+
+    def put(self, file):
+        self.work.put(file)
+        self.collect()
+
+    # hand uploaded files to on_done in batches
+    def collect(self, flush=False):
+        while True:
+            try:
+                target = self.done.get_nowait()
+            except queue.Empty:
+                break
+            if target is None:
+                self.running_ -= 1
+            else:
+                self.batch.append(target)
+        if self.batch and self.on_done and (flush or len(self.batch) >= 100
+                or time.perf_counter() - self.reported > 1.0):
+            self.on_done(self.batch)
+            self.batch = []
+            self.reported = time.perf_counter()
+
+    # wait for all files given
+    def finish(self):
+        for t in self.threads:
+            self.work.put(None)
+        # each worker puts None when it finishes
+        self.running_ = len(self.threads)
+        while self.running_:
+            try:
+                target = self.done.get(timeout=0.2)
+            except queue.Empty:
                 continue
-            for item, info in self.ftp.mlsd('.'):
-                if item == folder and info['type'] == 'dir':
-                    flag_ = True
+            if target is None:
+                self.running_ -= 1
+            else:
+                self.batch.append(target)
+            self.collect()
+        self.collect(flush=True)
+        for t in self.threads:
+            t.join()
+        self.threads = None
+        self.summary['seconds'] = time.perf_counter() - self.started
+        for file, error in self.summary['failed']:
+            print(f'failed to upload {file}: {error}', file=sys.stderr)
+        print(f"uploaded {self.summary['files']} files, "
+              f"{self.summary['bytes']} bytes in "
+              f"{self.summary['seconds']:.2f} seconds "
+              f"({self.summary['connections']} connections)")
+        return self.summary
+
+    def __upload_worker(self, work, done):
+        ftp = None
+        target = work.get()
+        if target is not None:
+            with self.lock:
+                ftp = self.idle.pop() if self.idle else None
+                self.summary['connections'] += 1
+        while target is not None:
+            for attempt in range(self.retries + 1):
+                try:
+                    if ftp is None:
+                        ftp = self.open_connection()
+                    started = time.perf_counter()
+                    sent = self.store(ftp, target)
+                except Exception as e:
+                    # start again with a fresh connection,
+                    # and learn the dir again
+                    if ftp is not None:
+                        self.close_connection(ftp)
+                        ftp = None
+                    self.forget_dir(self.split_path(target)[0])
+                    if (isinstance(e, self.retry_errors)
+                            and attempt < self.retries):
+                        with self.lock:
+                            self.summary['reconnects'] += 1
+                        continue
+                    with self.lock:
+                        self.summary['failed'].append(
+                            (target, f'{type(e).__name__}: {e}'))
                     break
-            if not flag_:
-                self.ftp.mkd(folder)
-                self.ftp.sendcmd(f'SITE CHMOD 755 {folder}')
-            self.ftp.cwd(folder)
-        #self.ftp.cwd(self.setting['server_info']['working_directory'])
-        f = target.split('/')[-1]
+                with self.lock:
+                    self.summary['files'] += 1
+                    self.summary['bytes'] += sent
+                    self.summary['latencies'].append(
+                        time.perf_counter() - started)
+                done.put(target)
+                break
+            target = work.get()
+        if ftp is not None:
+            with self.lock:
+                self.idle.append(ftp)
+        done.put(None)
+
+    # upload one file, returns size of it
+    def store(self, ftp, target):
+        dir_, name = self.split_path(target)
+        self.ensure_dir(ftp, dir_)
+        path_ = f'{dir_}/{name}' if dir_ else name
+        # stored by path, without cwd
         if target.endswith(self.ascii_ext):
             with open(self.setting['out_root'] + target, mode='rb') as fp:
-                self.ftp.storlines(f'STOR {f}', fp)
+                ftp.storlines(f'STOR {path_}', fp)
+                size_ = fp.tell()
         elif target.endswith(self.binary_ext):
             with open(self.setting['out_root'] + target, mode='rb') as fp:
-                self.ftp.storbinary(f'STOR {f}', fp)
+                ftp.storbinary(f'STOR {path_}', fp)
+                size_ = fp.tell()
         else:
             with open(self.setting['out_root'] + target, mode='rb') as fp:
-                self.ftp.storbinary(f'STOR {f}', fp)
-        self.ftp.sendcmd(f'SITE CHMOD 644 {f}')
-        self.ftp.cwd(self.setting['server_info']['working_directory'])
+                ftp.storbinary(f'STOR {path_}', fp)
+                size_ = fp.tell()
+        with self.tree_lock:
+            files = self.remote_files.setdefault(dir_, set())
+            is_new = name not in files
+            files.add(name)
+        # overwritten file keeps its mode
+        if self.chmod and is_new:
+            ftp.sendcmd(f'SITE CHMOD 644 {path_}')
+        return size_
+
+    # the connection may have been idle for a while (--watch)
+    def main_connection(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.voidcmd('NOOP')
+            except self.retry_errors:
+                self.ftp.close()
+                self.ftp = None
+        if self.ftp is None:
+            self.ftp = self.open_connection()
+        return self.ftp
+
+    # store data as a file (path is relative to working directory)
+    def put_bytes(self, target, data):
+        ftp = self.main_connection()
+        dir_, name = self.split_path(target)
+        self.ensure_dir(ftp, dir_)
+        path_ = f'{dir_}/{name}' if dir_ else name
+        ftp.storbinary(f'STOR {path_}', io.BytesIO(data))
+
+    # content of a file, or None if it does not exist
+    def get_bytes(self, target):
+        buf = io.BytesIO()
+        try:
+            self.main_connection().retrbinary(
+                f'RETR {target.lstrip("/")}', buf.write)
+        except ftplib.error_perm:
+            return None
+        return buf.getvalue()
+
+    def get_digest(self, target):
+        h = hashlib.blake2b(digest_size=16)
+        self.main_connection().retrbinary(
+            f'RETR {target.lstrip("/")}', h.update)
+        return h.hexdigest()
+
+    # {'/a/b.html': size, ...} of every file on the server
+    def walk_remote(self, dir_=''):
+        ftp = self.main_connection()
+        result = dict()
+        for item, info in ftp.mlsd(dir_ or '.', facts=['type', 'size']):
+            path_ = f'{dir_}/{item}' if dir_ else item
+            if info['type'] == 'dir':
+                result.update(self.walk_remote(path_))
+            elif info['type'] == 'file':
+                result['/' + path_] = int(info.get('size', -1))
+        return result
+
+    # '/a/b/c.html' -> ('a/b', 'c.html')
+    def split_path(self, target):
+        dir_, _, name = target.lstrip('/').rpartition('/')
+        return dir_, name
+
+    # make dir (and its parents) if it does not exist.
+    # each dir is listed or made only once in a session.
+    def ensure_dir(self, ftp, dir_):
+        with self.tree_lock:
+            if dir_ in self.remote_files:
+                return
+            parts = dir_.split('/') if dir_ else []
+            for i in range(len(parts) + 1):
+                d = '/'.join(parts[:i])
+                if d in self.remote_files:
+                    continue
+                if d in self.remote_dirs:
+                    self.list_dir(ftp, d)
+                    continue
+                try:
+                    ftp.mkd(d)
+                except ftplib.error_perm:
+                    # exists already (but was not known)
+                    self.remote_dirs.add(d)
+                    self.list_dir(ftp, d)
+                    continue
+                if self.chmod:
+                    ftp.sendcmd(f'SITE CHMOD 755 {d}')
+                self.remote_dirs.add(d)
+                self.remote_files[d] = set()
+
+    def list_dir(self, ftp, dir_):
+        files = set()
+        for item, info in ftp.mlsd(dir_ or '.', facts=['type']):
+            if info['type'] == 'dir':
+                self.remote_dirs.add(f'{dir_}/{item}' if dir_ else item)
+            elif info['type'] == 'file':
+                files.add(item)
+        self.remote_files[dir_] = files
+
+    def forget_dir(self, dir_):
+        with self.tree_lock:
+            self.remote_files.pop(dir_, None)
+            if dir_:
+                self.remote_dirs.discard(dir_)
 
 
 #
 # read and write something.
 #
+class LineCursor:
+    # consume lines from the top without moving the rest
+    def __init__(self, lines):
+        self.lines = lines
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.lines) - self.pos
+
+    # current line
+    def peek(self):
+        return self.lines[self.pos]
+
+    # current line, then go to next line
+    def next(self):
+        line = self.lines[self.pos]
+        self.pos += 1
+        return line
+
+    def append(self, line):
+        self.lines.append(line)
+
+
 class ContextManager:
     #source = []
     #html = ['']
@@ -479,28 +2567,40 @@ class ContextManager:
         self, text=None, path=None, src=None, out=None,
         indent_level=0, indent_str=' '):
         self.bread = False
+        # fragments of html, joined only once by getvalue()
         self.html = ['']
+        self.blank_line = True
         self.path = path
-        if text:
+        if src:
+            self.src_root = src
+        if out:
+            self.out_root = out
+        # an empty document is a document, not an index
+        if text is not None:
             self.text = text
-            self.source = text.split('\n')
+            self.source = LineCursor(text.split('\n'))
         else:
             self.text = None
-            self.source = self.generate_hoax_index(path)
+            self.source = LineCursor(self.generate_hoax_index(path))
         self.indent_level = indent_level
         self.indent_str = indent_str
         self.counter_dict = dict()
         self.annotation_count = 0
-        self.toc_buffer = ''
-        if src:
-            self.src_root = src
-        if out:
-            self.out_root = out
+        self.toc_buffer = []
+        # html from here is the text itself (after breadcrumbs)
+        self.text_from = 0
 
     def output(self, text, newline=False):
         if newline:
-            self.html.append(self.indent_str * self.indent_level)
-        self.html[-1] += text
+            self.html.append('\n' + self.indent_str * self.indent_level)
+            self.blank_line = True
+        if text:
+            self.html.append(text)
+            if self.blank_line and text.strip():
+                self.blank_line = False
+
+    def getvalue(self):
+        return ''.join(self.html)
 
     def indent(self):
         self.indent_level += 1
@@ -595,6 +2695,9 @@ class ContextManager:
         return dt.strftime(self.timestamp_format)
 
     def size_(self, path):
+        # output may be missing (e.g. failed to optimize)
+        if not os.path.exists(path):
+            return '-'
         byte = os.path.getsize(path)
         KB = round(byte / 1024, 3)
         return str(KB) + 'KB'
@@ -608,6 +2711,7 @@ class Node:
     indent = ' '
     context = None
     child = []
+    lexers = dict()
     
     def build_tag(self, tag_name, empty_element=False,
                 attributes=None, open=True, close=False):
@@ -625,22 +2729,39 @@ class Node:
         tag_ += '>'
         return tag_
 
+    # patterns of inline children joined into one alternation.
+    # at the same position, the earlier child in self.child wins.
+    @classmethod
+    def inline_lexer(cls):
+        key = tuple(cls.child)
+        if key not in Node.lexers:
+            pattern = '|'.join(map(lambda x:
+                                    f'(?P<c{x[0]}>{x[1].pattern.pattern})',
+                                    enumerate(key)))
+            Node.lexers[key] = re.compile(pattern)
+        return Node.lexers[key]
+
+    # scan the line once, text between inline children goes CDataNode
     def find_inline_child(self, txt):
-        for c in self.child:
-            found = c.pattern.search(txt)
-            if found:
-                pos_start, pos_end = found.span()
-                self.find_inline_child(txt[:pos_start])
-                node = c(self.context)
-                node.parse(txt[pos_start:pos_end])
-                self.find_inline_child(txt[pos_end:])
-                break
-        else:
+        pos = 0
+        for found in self.inline_lexer().finditer(txt):
+            pos_start, pos_end = found.span()
+            if pos_start > pos:
+                node = CDataNode(self.context)
+                node.parse(txt[pos:pos_start])
+            node = self.child[int(found.lastgroup[1:])](self.context)
+            node.parse(found.group())
+            pos = pos_end
+        if pos < len(txt):
             node = CDataNode(self.context)
-            node.parse(txt)
+            node.parse(txt[pos:])
 
 
 class RootNode:
+    # {name of node: [count, seconds]} of block nodes (with their
+    # inline children), collected while this is a dict
+    timings = None
+
     def __init__(self, context):
         self.context = context
 
@@ -649,16 +2770,17 @@ class RootNode:
             pass
         elif self.context.path:
             node = BreadCrumbNode(self.context)
-            node.parse()
+            self.parse_node(node)
         else:
             self.context.path = ''
             node = BreadCrumbNode(self.context)
-            node.parse()
+            self.parse_node(node)
+        self.context.text_from = len(self.context.html)
 
-        while len(self.context.source) > 0:
-            line = self.context.source[0]
+        while self.context.source:
+            line = self.context.source.peek()
             if len(line) == 0:
-                self.context.source.pop(0)
+                self.context.source.next()
                 continue
 
             for c in self.child:
@@ -667,7 +2789,17 @@ class RootNode:
                     break
             else:
                 node = PNode(self.context)
+            self.parse_node(node)
+
+    def parse_node(self, node):
+        if RootNode.timings is None:
             node.parse()
+            return
+        started = time.perf_counter()
+        node.parse()
+        total = RootNode.timings.setdefault(type(node).__name__, [0, 0.0])
+        total[0] += 1
+        total[1] += time.perf_counter() - started
 
 
 class CDataNode(Node):
@@ -686,7 +2818,7 @@ class HeaderNode(Node):
         self.context = context
 
     def parse(self):
-        line = self.context.source.pop(0)
+        line = self.context.source.next()
         symbol, txt = self.pattern.search(line).groups()
         lv = len(symbol)
         c = self.context.counter('AutoToc')
@@ -699,7 +2831,7 @@ class HeaderNode(Node):
             txt = f'<{txt} → #{self.id_prefix}{c:03}>'
             i_ = self.context.indent_str * lv
             tocline_ = f'{i_} - {txt}\n'
-            self.context.toc_buffer += tocline_
+            self.context.toc_buffer.append(tocline_)
         self.find_inline_child(txt)
         self.context.output(self.build_tag(tag_name=tag_name, close=True))
 
@@ -709,7 +2841,7 @@ class PNode(Node):
         self.context = context
 
     def parse(self):
-        txt = self.context.source.pop(0)
+        txt = self.context.source.next()
         self.context.output(
             self.build_tag(tag_name='p'),
             newline=True)
@@ -725,16 +2857,16 @@ class ListNode(Node):
 
     def parse(self):
         # Detect list type (ul/ol)
-        txt = self.context.source[0]
+        txt = self.context.source.peek()
         symbol_ = self.pattern.search(txt).groups()[1]
         tag_name = 'ul' if symbol_ == '-' else 'ol'
         tag = self.build_tag(tag_name)
         self.context.output(tag, newline=True)
         self.context.indent()
         read_ahead = True
-        while self.pattern.search(self.context.source[0]):
+        while self.pattern.search(self.context.source.peek()):
             grps = self.pattern.search(
-                    self.context.source.pop(0)).groups()
+                    self.context.source.next()).groups()
             indent, symbol, txt = grps
             depth = len(indent)
             txt = txt.strip()
@@ -752,9 +2884,9 @@ class ListNode(Node):
                         close=True))
                 break
             else:
-                is_list = self.is_list(self.context.source[0])
+                is_list = self.is_list(self.context.source.peek())
                 if is_list:
-                    depth_ = self.check_indent(self.context.source[0])
+                    depth_ = self.check_indent(self.context.source.peek())
             # case1: next line is in same indent
             #   -> just close LI, then continue this loop
             if (is_list and depth_ == depth):
@@ -798,14 +2930,28 @@ class ListNode(Node):
 
 class ImgNode(Node):
     pattern = re.compile('^img:([^\(]*)(\((.*)\))?$')
+    # variants made by ImageManager (see configure),
+    # only local jpg has them
+    widths = []
+    webp = False
+    sizes = None
+    im = None
+
+    @classmethod
+    def configure(cls, setting):
+        cls.widths = sorted(setting.get('img_widths', []))
+        cls.webp = setting.get('img_webp', False)
+        # None: the width of each image
+        cls.sizes = setting.get('img_sizes')
+        cls.im = ImageManager.from_setting(setting)
 
     def __init__(self, context):
         self.context = context
-        if self.context.html[-1].strip() != '':
+        if not self.context.blank_line:
             self.context.output('', newline=True)
 
     def parse(self):
-        line = self.context.source.pop(0)
+        line = self.context.source.next()
         img_path, s, caption = self.pattern.search(line).groups()
         self.context.output(
             self.build_tag(
@@ -813,12 +2959,21 @@ class ImgNode(Node):
                 attributes={'class': 'image'}),
             newline=True)
         self.context.indent()
-        self.context.output(
-            self.build_tag(
-                tag_name='img',
-                attributes={'src': img_path},
-                empty_element=True),
-            newline=True)
+        size = None
+        if ((self.widths or self.webp)
+                and ImageManager.is_jpg(img_path)
+                and not urllib.parse.urlsplit(img_path).netloc
+                and not urllib.parse.urlsplit(img_path).scheme):
+            size = self.output_size(img_path)
+        if size:
+            self.output_picture(img_path, size[0])
+        else:
+            self.context.output(
+                self.build_tag(
+                    tag_name='img',
+                    attributes={'src': img_path},
+                    empty_element=True),
+                newline=True)
         if caption:
             self.context.output(
                 self.build_tag(tag_name='figcaption'),
@@ -839,18 +2994,79 @@ class ImgNode(Node):
             newline=True)
 
 
+    # size of the image ImageManager makes, None if not readable
+    def output_size(self, img_path):
+        if img_path.startswith('/'):
+            file = self.context.src_root + img_path
+        else:
+            file = (self.context.src_root
+                    + os.path.dirname(self.context.path) + '/' + img_path)
+        try:
+            return self.im.output_size(file)
+        except OSError:
+            return None
+
+    # <picture> with WebP source and srcset of smaller variants
+    def output_picture(self, img_path, width):
+        sizes = self.sizes or f'(max-width: {width}px) 100vw, {width}px'
+        self.context.output(
+            self.build_tag(tag_name='picture'),
+            newline=True)
+        self.context.indent()
+        if self.webp:
+            attributes = {
+                'type': 'image/webp',
+                'srcset': self.srcset(img_path, width, '.webp')}
+            if self.widths:
+                attributes['sizes'] = sizes
+            self.context.output(
+                self.build_tag(
+                    tag_name='source',
+                    attributes=attributes,
+                    empty_element=True),
+                newline=True)
+        attributes = {'src': img_path}
+        if self.widths:
+            attributes['srcset'] = self.srcset(img_path, width)
+            attributes['sizes'] = sizes
+        self.context.output(
+            self.build_tag(
+                tag_name='img',
+                attributes=attributes,
+                empty_element=True),
+            newline=True)
+        self.context.dedent()
+        self.context.output(
+            self.build_tag(tag_name='picture', close=True),
+            newline=True)
+
+    # variants narrower than the image, and the image at its width
+    def srcset(self, img_path, width, ext=None):
+        if not self.widths:
+            return ImageManager.variant_of(img_path, None, ext)
+        return ', '.join(map(lambda x:
+                                f'{ImageManager.variant_of(img_path, x[0], ext)} '
+                                f'{x[1]}w',
+                                list(map(lambda y:
+                                            (y, y),
+                                            filter(lambda y:
+                                                    y < width,
+                                                    self.widths)))
+                                + [(None, width)]))
+
+
 class BlockquoteNode(Node):
     pattern = re.compile('^<from:(.*)$')
     pattern_close = re.compile('^>$')
 
     def __init__(self, context):
         self.context = context
-        if self.context.html[-1].strip() != '':
+        if not self.context.blank_line:
             self.context.output('', newline=True)
 
     def parse(self):
         source = self.pattern.search(
-            self.context.source.pop(0)).group(1).strip()
+            self.context.source.next()).group(1).strip()
         source_is_link = False if source[:4] != 'http' else True
         self.context.output(
             self.build_tag(
@@ -869,14 +3085,14 @@ class BlockquoteNode(Node):
         self.context.indent()
 
         while True:
-            if len(self.context.source) == 0 or self.pattern_close.search(self.context.source[0]):
+            if len(self.context.source) == 0 or self.pattern_close.search(self.context.source.peek()):
                 break
-            if len(self.context.source[0]) == 0:
-                self.context.source.pop()
+            if len(self.context.source.peek()) == 0:
+                self.context.source.next()
                 continue
 
             for c in self.child:
-                if c.pattern.search(self.context.source[0]) != None:
+                if c.pattern.search(self.context.source.peek()) != None:
                     node = c(self.context)
                     break
             else:
@@ -914,7 +3130,7 @@ class BlockquoteNode(Node):
                 close=True),
             newline=True)
         if len(self.context.source) != 0:
-            self.context.source.pop(0)
+            self.context.source.next()
 
 
 class TableNode(Node):
@@ -928,12 +3144,12 @@ class TableNode(Node):
             self.build_tag(tag_name='table'),
             newline=True)
         self.context.indent()
-        while len(self.context.source) > 0 and self.pattern.search(self.context.source[0]):
+        while len(self.context.source) > 0 and self.pattern.search(self.context.source.peek()):
             self.context.output(
                 self.build_tag(tag_name='tr'),
                 newline=True)
             self.context.indent()
-            cells = self.context.source.pop(0).split('|')[1:-1]
+            cells = self.context.source.next().split('|')[1:-1]
             self.context.output('', newline=True)
             for c in cells:
                 c = c.strip()
@@ -1086,7 +3302,7 @@ class BreadCrumbNode(Node):
             name_ = (target + p[-1] + os.sep +
                         self.context.name_file)
             if self.context.text:
-                title = self.context.source[0][1:].strip()
+                title = self.context.source.peek()[1:].strip()
             elif os.path.exists(name_):
                 with open(name_, encoding='utf-8') as fp:
                     title = fp.read().split('\n')[0].strip()
@@ -1144,8 +3360,14 @@ if __name__ == '__main__':
     
     # get given setting_file. if not given,
     # 'setting.json' will be used.
+    #   --verify-remote: rebuild manifest of remote files from the server
+    #   --watch: build again whenever src_root changes
+    #   --serve: preview pages rendered in memory, nothing is built
+    #   --report: print time, counts and bytes of each phase
+    #   --profile: build under cProfile (stats go to profile_file)
+    options = list(filter(lambda x: x.startswith('--'), sys.argv))
     for arg in sys.argv:
-        if not arg.endswith(myname_):
+        if not arg.endswith(myname_) and not arg.startswith('--'):
             file_ = arg
             break
     else:
@@ -1155,7 +3377,19 @@ if __name__ == '__main__':
         json_ = fp.read()
     setting = json.loads(json_)
     sb = SiteBuilder(setting)
-    sb.build()
+    if '--verify-remote' in options:
+        sb.verify_remote()
+    if '--serve' in options:
+        sb.serve()
+    elif '--watch' in options:
+        sb.watch()
+    elif '--profile' in options:
+        sb.profile(setting.get('profile_file', 'build.prof'))
+    else:
+        sb.build()
+    if '--report' in options:
+        print(sb.report.table())
+    sb.close()
 
 # test comment
 # This is a test comment from Editor of Github Codespaces.
@@ -0,0 +1,347 @@
+import argparse
+import ftplib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import PIL.Image
+
+#
+# load 0xCC.py (its name is not importable)
+#
+def load_compiler(path=None):
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '0xCC.py')
+    spec = importlib.util.spec_from_file_location('occ', path)
+    module = importlib.util.module_from_spec(spec)
+    # worker processes find their functions by the module name
+    sys.modules['occ'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+#
+# synthetic source tree
+#
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', '日本語', 'を',
+         'ダラダラ', '書く', 'static', 'site', 'compiler', 'page')
+
+class SiteGenerator:
+    # density: probability of each construct in a section
+    def __init__(self, pages=200, depth=3, fanout=3, sections=6,
+                 lists=0.5, tables=0.3, annotations=0.3, quotes=0.2,
+                 jpgs=10, jpg_size=(1600, 1200), seed=0):
+        self.pages = pages
+        self.depth = depth
+        self.fanout = fanout
+        self.sections = sections
+        self.lists = lists
+        self.tables = tables
+        self.annotations = annotations
+        self.quotes = quotes
+        self.jpgs = jpgs
+        self.jpg_size = tuple(jpg_size)
+        self.random = random.Random(seed)
+
+    def generate(self, src_root):
+        dirs = self.make_dirs(src_root)
+        images = self.make_images(src_root)
+        pages = []
+        for i in range(self.pages):
+            dir_ = dirs[i % len(dirs)]
+            path = f'{dir_}/page{i:05d}.txt'
+            with open(src_root + path, mode='w', encoding='utf-8') as fp:
+                fp.write(self.page(i, images))
+            pages.append(path)
+        return pages
+
+    # '' and nested dirs, each with a name file
+    def make_dirs(self, src_root):
+        dirs = ['']
+        level = ['']
+        for d in range(self.depth):
+            level = list(map(lambda x:
+                                f'{x[0]}/d{d}{x[1]}',
+                                [(p, n) for p in level
+                                        for n in range(self.fanout)]))
+            dirs += level
+        for dir_ in dirs:
+            os.makedirs(src_root + dir_, exist_ok=True)
+            if dir_:
+                with open(src_root + dir_ + '/_name', mode='w',
+                          encoding='utf-8') as fp:
+                    fp.write(f'Folder {dir_.split("/")[-1]}\n')
+        return dirs
+
+    def make_images(self, src_root):
+        os.makedirs(src_root + '/res/img', exist_ok=True)
+        images = []
+        for i in range(self.jpgs):
+            path = f'/res/img/{i:04d}.jpg'
+            # noise does not compress, like photos.
+            # from the seed, so every run gets the same images
+            bands = list(map(lambda x:
+                                PIL.Image.frombytes(
+                                    'L', self.jpg_size,
+                                    self.random.randbytes(
+                                        self.jpg_size[0] * self.jpg_size[1])),
+                                range(3)))
+            PIL.Image.merge('RGB', bands).save(
+                src_root + path, 'JPEG', quality=90)
+            images.append(path)
+        return images
+
+    def sentence(self, n=12):
+        text = ' '.join(self.random.choices(words, k=n))
+        if self.random.random() < self.annotations:
+            text += f'(*:{" ".join(self.random.choices(words, k=4))})'
+        return text + '。'
+
+    # constructs of sample.txt
+    def page(self, n, images):
+        r = self.random
+        lines = [f'# Page {n}', '', self.sentence(), '']
+        for s in range(self.sections):
+            lines += [f'## Section {s}', '', self.sentence(20), '']
+            if r.random() < self.lists:
+                lines += ['- ' + self.sentence(4), '- ' + self.sentence(4),
+                          '    - ' + self.sentence(3),
+                          '        + ' + self.sentence(3),
+                          '- ' + self.sentence(4), '']
+            if r.random() < self.tables:
+                lines += ['|*name*|*value*|*note*|']
+                lines += list(map(lambda x:
+                                    f'|row {x}|{x * 7}|{self.sentence(3)}|',
+                                    range(5)))
+                lines += ['']
+            if r.random() < self.quotes:
+                lines += ['<from: https://example.com', self.sentence(),
+                          '- ' + self.sentence(3), '>', '']
+            if images and r.random() < 0.3:
+                lines += [f'img:{r.choice(images)}(caption {s})', '']
+            lines += [f'<link {s} → ./page{n:05d}.html#s{s}>', '']
+        return '\n'.join(lines) + '\n'
+
+
+#
+# FTP stand-in: ftplib.FTP interface on a local dir
+#
+class LocalFTP:
+    root = None
+    # seconds of round trip added to each command
+    latency = 0.0
+
+    def connect(self, host='', port=0, timeout=None):
+        self.wait()
+        self.cwd_ = self.root
+
+    def login(self, user='', passwd=''):
+        self.wait()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def path(self, name):
+        return os.path.join(self.cwd_, name)
+
+    def cwd(self, dir_):
+        self.wait()
+        self.cwd_ = os.path.join(self.root, dir_.lstrip('/'))
+        os.makedirs(self.cwd_, exist_ok=True)
+
+    def mkd(self, dir_):
+        self.wait()
+        try:
+            os.mkdir(self.path(dir_))
+        except FileExistsError:
+            # as ftplib does for an error reply
+            raise ftplib.error_perm('550 exists')
+
+    def mlsd(self, path='', facts=[]):
+        self.wait()
+        for entry in os.scandir(self.path(path)):
+            if entry.is_dir():
+                yield entry.name, {'type': 'dir'}
+            else:
+                yield entry.name, {'type': 'file',
+                                   'size': str(entry.stat().st_size)}
+
+    def storbinary(self, cmd, fp, blocksize=8192):
+        self.wait()
+        with open(self.path(cmd[5:]), mode='wb') as out:
+            shutil.copyfileobj(fp, out, blocksize)
+
+    def storlines(self, cmd, fp):
+        self.storbinary(cmd, fp)
+
+    def retrbinary(self, cmd, callback, blocksize=8192):
+        self.wait()
+        if not os.path.isfile(self.path(cmd[5:])):
+            raise ftplib.error_perm('550 not found')
+        with open(self.path(cmd[5:]), mode='rb') as fp:
+            for block in iter(lambda: fp.read(blocksize), b''):
+                callback(block)
+
+    def sendcmd(self, cmd):
+        self.wait()
+        return '200 OK'
+
+    def voidcmd(self, cmd):
+        return self.sendcmd(cmd)
+
+    def quit(self):
+        self.wait()
+
+    def close(self):
+        pass
+
+
+#
+# run builds
+#
+class Bench:
+    def __init__(self, occ, work, workers=1, connections=1, latency=0.0):
+        self.occ = occ
+        self.work = work
+        self.workers = workers
+        self.connections = connections
+        LocalFTP.root = os.path.join(work, 'remote')
+        LocalFTP.latency = latency
+        self.setting = {
+            'site_name': 'Bench',
+            'src_root': os.path.join(work, 'src'),
+            'out_root': os.path.join(work, 'out'),
+            'db_file': os.path.join(work, 'site.sq3'),
+            'img_max_length': 1280,
+            'ignore_files': ['_name'],
+            'workers': workers,
+            'upload_connections': connections,
+            'templates': {
+                'document': os.path.join(os.path.dirname(
+                    os.path.abspath(__file__)), 'templates/document.html'),
+                'index': os.path.join(os.path.dirname(
+                    os.path.abspath(__file__)), 'templates/index.html')},
+            'server_info': {
+                'address': 'localhost', 'port': 21,
+                'username': 'bench', 'password': 'bench',
+                'working_directory': '/public_html'}}
+
+    # forget everything built before
+    def reset(self):
+        for name in ('out', 'remote'):
+            shutil.rmtree(os.path.join(self.work, name), ignore_errors=True)
+        os.makedirs(os.path.join(self.work, 'out'))
+        if os.path.exists(self.setting['db_file']):
+            os.remove(self.setting['db_file'])
+
+    def build(self):
+        started = time.perf_counter()
+        cpu = time.process_time()
+        # output of the compiler is not part of the result
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            sb = self.occ.SiteBuilder(self.setting)
+            sb.uploader = self.occ.Uploader(self.setting, LocalFTP)
+            sb.build()
+            sb.close()
+        finally:
+            sys.stdout = stdout
+        result = dict(sb.report.phases)
+        result['total'] = time.perf_counter() - started
+        result['cpu'] = time.process_time() - cpu
+        return result
+
+    # cold, no-op and single file edit builds
+    def run(self, page, repeat=3):
+        results = {'cold': [], 'noop': [], 'edit': []}
+        for i in range(repeat):
+            self.reset()
+            results['cold'].append(self.build())
+            results['noop'].append(self.build())
+            with open(self.setting['src_root'] + page, mode='a',
+                      encoding='utf-8') as fp:
+                fp.write(f'\nedited {time.time()}\n')
+            results['edit'].append(self.build())
+        # median of each phase
+        return dict(map(lambda x:
+                            (x[0], dict(map(lambda y:
+                                            (y, statistics.median(
+                                                map(lambda z: z[y], x[1]))),
+                                            x[1][0]))),
+                            results.items()))
+
+
+def compare(result, baseline):
+    print(f'{"":8}{"phase":10}{"baseline":>10}{"now":>10}{"ratio":>8}')
+    for scenario, phases in result['results'].items():
+        base_ = baseline['results'].get(scenario, dict())
+        for phase, seconds in phases.items():
+            if phase in base_:
+                ratio = seconds / base_[phase] if base_[phase] else 0.0
+                print(f'{scenario:8}{phase:10}{base_[phase]:10.4f}'
+                      f'{seconds:10.4f}{ratio:8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='time each phase of SiteBuilder.build on a synthetic site')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--sections', type=int, default=6)
+    parser.add_argument('--lists', type=float, default=0.5)
+    parser.add_argument('--tables', type=float, default=0.3)
+    parser.add_argument('--annotations', type=float, default=0.3)
+    parser.add_argument('--quotes', type=float, default=0.2)
+    parser.add_argument('--jpgs', type=int, default=10)
+    parser.add_argument('--jpg-size', type=int, nargs=2, default=(1600, 1200))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to each FTP command')
+    parser.add_argument('--compiler', help='path of 0xCC.py to measure')
+    parser.add_argument('--work', help='dir for the site (kept)')
+    parser.add_argument('--output', help='write result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare with')
+    args = parser.parse_args()
+
+    work = args.work or tempfile.mkdtemp(prefix='0xcc-bench-')
+    generator = SiteGenerator(
+        pages=args.pages, depth=args.depth, fanout=args.fanout,
+        sections=args.sections, lists=args.lists, tables=args.tables,
+        annotations=args.annotations, quotes=args.quotes, jpgs=args.jpgs,
+        jpg_size=args.jpg_size, seed=args.seed)
+    shutil.rmtree(os.path.join(work, 'src'), ignore_errors=True)
+    pages = generator.generate(os.path.join(work, 'src'))
+
+    bench = Bench(load_compiler(args.compiler), work,
+                  args.workers, args.connections, args.latency)
+    result = {
+        'params': vars(args),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'results': bench.run(pages[len(pages) // 2], args.repeat)}
+    if not args.work:
+        shutil.rmtree(work)
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, mode='w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            compare(result, json.load(fp))